@@ -1,5 +1,4 @@
 import os
-import re
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,79 +22,98 @@ BUFFER_SIZE = 20000
 
 N_EPOCHS = 20
 
-import urllib3
-import zipfile
-import shutil
 import pandas as pd
 
+from cornell_corpus import fetch_corpus, extract_corpus, load_dialog_pairs_parallel
+from corpus_store import open_corpus_store
+from text_preprocessing import preprocess_eng, cached_preprocess, cache_hit_rate
+from tokenizer_utils import (batch_tokenizer, pad_ragged, save_tokenizer,
+                             compact_ids, vocab_coverage)
+from data_pipeline import (word_lengths, within_len, dedup_pairs, filter_pairs_by_len,
+                           reservoir_sample, sample_pairs, near_dedup, near_dedup_pairs)
+from token_shards import export_token_shards, read_token_shards
+from bucketing import bucket_by_length, num_batches, padding_report, print_padding_report, TokenRate
+
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'http://www.cs.cornell.edu/~cristian/data/cornell_movie_dialogs_corpus.zip'
-filename = 'cornell_movie_dialogs_corpus.zip'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-with zipfile.ZipFile(zipfilename, 'r') as zip_ref:
-    zip_ref.extractall(path)
-
-# ! unzip cornell_movie_dialogs_corpus.zip
-path_to_movie_lines = '/content/cornell movie-dialogs corpus/movie_lines.txt'
-path_to_movie_conversations = '/content/cornell movie-dialogs corpus/movie_conversations.txt'
-
-# Option 1
-def preprocess_eng(sentence):
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    return sentence
+# 코퍼스는 로컬 캐시에 한 번만 내려받고, 이후 실행에서는 체크섬만 확인한다.
+# zip 파일은 압축을 풀지 않고 그대로 스트리밍해서 읽는다.
+zipfilename = fetch_corpus()
+
+# 처음 한 번만 파싱해서 바이너리 저장소로 만들고, 이후에는 memory-map 으로 바로 읽는다.
+corpus_store = open_corpus_store(zipfilename)
+
+# 1 보다 크면 대용량 코퍼스를 바이트 구간으로 나누어 여러 프로세스에서 전처리한다.
+N_INGEST_WORKERS = 0
+
+# 전처리 결과를 재사용하는 LRU 캐시의 최대 문장 수
+NORMALIZE_CACHE_SIZE = 1 << 18
+
+# 학습 데이터 샘플링 방식
+#   'random'     : train_df.sample(n=N_SAMPLES) (기존 방식)
+#   'full'       : 길이 조건을 만족하는 모든 쌍
+#   'reservoir'  : 수집 단계의 스트림에서 바로 N_SAMPLES 개를 뽑는다 (대용량 코퍼스)
+#   'stratified' : 문장 길이 구간별 비율을 유지하면서 N_SAMPLES 개를 뽑는다
+SAMPLE_MODE = 'random'
+N_SAMPLES   = 1024*8
+
+# 0 ~ 1 사이 값으로 설정하면 MinHash/LSH 로 추정한 Jaccard 유사도가 이 값 이상인
+# 거의 같은 질문, 답변을 제거한다. (None 이면 사용하지 않음)
+NEAR_DUP_THRESHOLD = None
+
+# 단어 집합 크기 상한. 빈도 상위 단어만 MAX_VOCAB_SIZE - 1 번까지 번호를 주고 나머지는 <unk> 로 바꾼다.
+# (None 이면 모든 단어 사용) python tokenizer_utils.py 로 크기별 OOV 비율과 출력층 속도를 비교할 수 있다.
+MAX_VOCAB_SIZE = None
+
+# True 이면 질문과 답변이 하나의 단어 집합(tokenizer)을 같이 쓴다.
+SHARED_VOCAB   = False
+# SHARED_VOCAB 일 때 Encoder / Decoder 임베딩과 출력층(fin_output)이 같은 가중치를 쓴다.
+TIE_EMBEDDINGS = False
+
+# True 이면 정수 인코딩 결과를 압축된 TFRecord 샤드로 한 번 내보내고, 학습은 샤드를 병렬로 읽어서 한다.
+# (데이터셋이 그래프에 상수로 들어가지 않고, 메모리보다 큰 데이터도 스트리밍할 수 있다)
+USE_TOKEN_SHARDS = False
+
+# 'fixed'  : 모든 문장을 ENCODER_LEN / DECODER_LEN 까지 패딩한 배치 (기존 방식)
+# 'bucket' : 길이가 비슷한 문장끼리 배치를 만들고, 배치마다 가장 긴 문장 길이까지만 남긴다.
+# python bucketing.py 로 패딩 비율과 초당 토큰 수를 비교할 수 있다.
+BATCH_MODE   = 'fixed'
+# 'bucket' 일 때 배치 하나의 토큰 수 (None 이면 길이와 상관없이 BATCH_SIZE 개씩)
+TOKEN_BUDGET = None
+# 시작할 때 앞쪽 배치 PADDING_REPORT_BATCHES 개로 패딩 비율을 출력한다. (None 이면 출력하지 않는다)
+# 데이터셋 전체를 미리 읽지 않도록 일부 배치만 확인한다.
+PADDING_REPORT_BATCHES = None
 
 def load_preprocessed_data():
-    # dictionary of line id to text
-    id2line = {}
-    with open(path_to_movie_lines, errors='ignore') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        id2line[parts[0]] = parts[4]
+    # 같은 문장이 여러 번 나오므로 전처리 결과를 LRU 캐시에 저장해 재사용한다.
+    normalize = cached_preprocess(NORMALIZE_CACHE_SIZE)
+
+    if N_INGEST_WORKERS > 1:
+        corpus_dir = extract_corpus(zipfilename, os.getcwd())
+        pairs = zip(*load_dialog_pairs_parallel(corpus_dir, preprocess_eng, N_INGEST_WORKERS))
+    else:
+        # (질문, 답변) 쌍을 미리 파싱해 둔 저장소에서 읽어온다.
+        pairs = ((normalize(src_line), normalize(trg_line))
+                 for src_line, trg_line in corpus_store.iter_pairs())
+
+    # 앞에서 이미 나온 질문, 답변은 64비트 해시로 바로 걸러낸다. (처음 나온 쌍만 남긴다)
+    pairs = dedup_pairs(pairs)
+    if SAMPLE_MODE == 'reservoir':
+        # 코퍼스 전체를 메모리에 올리지 않고 스트림에서 바로 N_SAMPLES 개를 뽑는다.
+        pairs = filter_pairs_by_len(pairs, 4, 20)
+        if NEAR_DUP_THRESHOLD is not None:
+            # 샘플링 전에 거의 같은 질문, 답변을 걸러야 N_SAMPLES 개를 모두 채운다.
+            pairs = near_dedup_pairs(pairs, threshold=NEAR_DUP_THRESHOLD)
+        pairs = reservoir_sample(pairs, N_SAMPLES, seed=1234)
 
     processed_src, processed_trg = [], []
-    with open(path_to_movie_conversations, 'r') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        # get conversation in a list of line ID
-        conversation = [line[1:-1] for line in parts[3][1:-1].split(', ')]
-        for i in range(len(conversation) - 1):
-            processed_src.append(preprocess_eng(id2line[conversation[i]]))
-            processed_trg.append(preprocess_eng(id2line[conversation[i + 1]]))
+    for src_line, trg_line in pairs:
+        processed_src.append(src_line)
+        processed_trg.append(trg_line)
 
+    if N_INGEST_WORKERS <= 1:
+        print('Normalize cache :', normalize.cache_info())
+        print('Cache hit rate  : {:.1%}'.format(cache_hit_rate(normalize)))
     return processed_src, processed_trg
 
 # 인코딩 테스트
@@ -114,38 +132,26 @@ df1.rename(columns={0: "SRC"}, errors="raise", inplace=True)
 df2.rename(columns={0: "TRG"}, errors="raise", inplace=True)
 train_df = pd.concat([df1, df2], axis=1)
 
-train_df["src_len"] = ""
-train_df["trg_len"] = ""
+# 공백 기준 단어 수를 한 번에(벡터 연산으로) 계산한다.
+train_df["src_len"] = word_lengths(train_df['SRC'])
+train_df["trg_len"] = word_lengths(train_df['TRG'])
 train_df.head()
 
-for idx in range(len(train_df['SRC'])):
-    # initialize string
-    text_eng = str(train_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    train_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(train_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    train_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["TRG"])
+# 중복된 질문, 답변은 load_preprocessed_data() 에서 이미 제거되었다.
 print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
 
 # 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (4 < train_df['src_len']) & (train_df['src_len'] <= 20) & (4 < train_df['trg_len']) & (train_df['trg_len'] <=20)
+is_within_len = within_len(train_df, 4, 20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
 train_df = train_df[is_within_len]
 
-dataset_df_8096 = train_df.sample(n=1024*8, # number of items from axis to return.
-          random_state=1234) # seed for random number generator for reproducibility
+if NEAR_DUP_THRESHOLD is not None and SAMPLE_MODE != 'reservoir':
+    # 거의 같은 질문, 답변을 제거한다. (reservoir 는 load_preprocessed_data() 에서 이미 제거)
+    train_df = near_dedup(train_df, threshold=NEAR_DUP_THRESHOLD)
+    print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
+
+dataset_df_8096 = sample_pairs(train_df, N_SAMPLES, # number of items from axis to return.
+          mode=SAMPLE_MODE, seed=1234) # seed for random number generator for reproducibility
 
 print('Translation Pair :',len(dataset_df_8096)) # 리뷰 개수 출력
 
@@ -159,12 +165,29 @@ filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
 oov_token = '<unk>'
 
 # Define tokenizer
-SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
+if SHARED_VOCAB:
+    # 같은 tokenizer 에 질문과 답변을 차례로 학습시켜 하나의 단어 집합을 만든다.
+    TRG_tokenizer = SRC_tokenizer
+else:
+    TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
 
 SRC_tokenizer.fit_on_texts(src_sentence)
 TRG_tokenizer.fit_on_texts(trg_sentence)
 
+if MAX_VOCAB_SIZE:
+    # 상위 단어만 남겼을 때 학습 데이터에서 <unk> 로 바뀌는 토큰의 비율
+    for name, fitted in (('SRC', SRC_tokenizer), ('TRG', TRG_tokenizer)):
+        coverage = vocab_coverage(fitted)
+        print('{} coverage : {:.2%}, OOV : {:.2%}'.format(
+            name, coverage['token_coverage'], coverage['oov_rate']))
+
+# 학습에 쓴 tokenizer 는 단어 집합과 설정만 남긴 읽기 전용 tokenizer 로 바꾸어 체크포인트 폴더에 저장한다.
+# 추론할 때는 tokenizer_utils.load_tokenizer(os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json')) 로 코퍼스 없이 바로 읽어온다.
+TOKENIZER_DIR = "./checkpoints"
+SRC_tokenizer = save_tokenizer(SRC_tokenizer, os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json'))
+TRG_tokenizer = save_tokenizer(TRG_tokenizer, os.path.join(TOKENIZER_DIR, 'TRG_tokenizer.json'))
+
 n_enc_vocab = len(SRC_tokenizer.word_index) + 1
 n_dec_vocab = len(TRG_tokenizer.word_index) + 1
 
@@ -197,15 +220,22 @@ for line in lines:
     print("ids_2_txt :", ids_2_txt[0],"\n")
     
 # 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
-tokenized_inputs  = SRC_tokenizer.texts_to_sequences(src_sentence)
-tokenized_outputs = TRG_tokenizer.texts_to_sequences(trg_sentence)
+# 문장 목록 전체를 한 번에 정수 인코딩한다. (texts_to_sequences 와 같은 번호의 RaggedTensor)
+SRC_encoder = batch_tokenizer(SRC_tokenizer)
+TRG_encoder = batch_tokenizer(TRG_tokenizer)
+
+tokenized_inputs  = SRC_encoder(src_sentence)
+tokenized_outputs = TRG_encoder(trg_sentence)
 
 # 패딩
-tkn_sources = tf.keras.preprocessing.sequence.pad_sequences(tokenized_inputs,  maxlen=ENCODER_LEN, padding='post', truncating='post')
-tkn_targets = tf.keras.preprocessing.sequence.pad_sequences(tokenized_outputs, maxlen=DECODER_LEN, padding='post', truncating='post')
+tkn_sources = pad_ragged(tokenized_inputs,  ENCODER_LEN, truncating='post')
+tkn_targets = pad_ragged(tokenized_outputs, DECODER_LEN, truncating='post')
 
-tkn_sources = tf.cast(tkn_sources, dtype=tf.int64)
-tkn_targets = tf.cast(tkn_targets, dtype=tf.int64)
+# 데이터셋 캐시와 디바이스 전송에는 id 를 int64 대신 int16 / int32 로 저장한다.
+# (train_step 에서 디바이스로 옮겨진 뒤 int64 로 바꾼다)
+tkn_sources, tkn_targets = compact_ids(
+    tkn_sources, tkn_targets, vocab_size=max(n_enc_vocab, n_dec_vocab))
+print('토큰 저장 dtype :', tkn_sources.dtype.name, '(int64 의 1/{})'.format(8 // tkn_sources.dtype.size))
 
 print('질문 데이터의 크기(shape) :', tkn_sources.shape)
 print('답변 데이터의 크기(shape) :', tkn_targets.shape)
@@ -221,13 +251,28 @@ pf_dim    = 1024
 n_heads   = 8
 dropout   = 0.3
 
-dataset = tf.data.Dataset.from_tensor_slices((tkn_sources, tkn_targets))
+if USE_TOKEN_SHARDS:
+    # 같은 데이터는 한 번만 내보낸다. (캐시 폴더의 shards/<해시> 아래)
+    shard_dir = export_token_shards({'inputs': tkn_sources, 'targets': tkn_targets})
+    print('토큰 샤드 :', shard_dir)
+    dataset = read_token_shards(shard_dir)
+else:
+    dataset = tf.data.Dataset.from_tensor_slices((tkn_sources, tkn_targets))
+    dataset = dataset.cache()
 
-dataset = dataset.cache()
 dataset = dataset.shuffle(BUFFER_SIZE)
-dataset = dataset.batch(BATCH_SIZE)
+if BATCH_MODE == 'bucket':
+    # 배치의 패딩은 가장 긴 문장 길이(8 의 배수)까지만 남긴다.
+    dataset = bucket_by_length(dataset, BATCH_SIZE, trim_by=(0, 1), token_budget=TOKEN_BUDGET)
+else:
+    dataset = dataset.batch(BATCH_SIZE)
 dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
+# 패딩이 차지하는 비율
+if PADDING_REPORT_BATCHES:
+    print_padding_report(BATCH_MODE, padding_report(dataset, components=(0, 1),
+                                                    max_batches=PADDING_REPORT_BATCHES))
+
 """ sinusoid position encoding """
 def get_sinusoid_encoding_table(position, hid_dim):
     # angle_rads = get_angles(np.arange(position)[:, np.newaxis],
@@ -411,13 +456,14 @@ class EncoderLayer(tf.keras.layers.Layer):
 """ encoder """
 class Encoder(tf.keras.layers.Layer):
     def __init__(self, n_enc_vocab, n_layers, pf_dim, hid_dim, n_heads,
-                 maximum_position_encoding, dropout):
+                 maximum_position_encoding, dropout, embedding=None):
         super(Encoder, self).__init__()
 
         self.hid_dim    = hid_dim
         self.n_layers = n_layers
 
-        self.embedding = tf.keras.layers.Embedding(n_enc_vocab, hid_dim)
+        # embedding 이 주어지면 (tied embedding) 그 층을 같이 쓴다.
+        self.embedding = embedding or tf.keras.layers.Embedding(n_enc_vocab, hid_dim)
         self.pos_encoding = get_sinusoid_encoding_table(maximum_position_encoding,
                                                 self.hid_dim)
 
@@ -482,13 +528,13 @@ class DecoderLayer(tf.keras.layers.Layer):
 """ decoder """
 class Decoder(tf.keras.layers.Layer):
     def __init__(self, n_dec_vocab, n_layers, pf_dim, hid_dim, n_heads, 
-                 maximum_position_encoding, dropout):
+                 maximum_position_encoding, dropout, embedding=None):
         super(Decoder, self).__init__()
 
         self.hid_dim = hid_dim
         self.n_layers = n_layers
 
-        self.embedding = tf.keras.layers.Embedding(n_dec_vocab, hid_dim)
+        self.embedding = embedding or tf.keras.layers.Embedding(n_dec_vocab, hid_dim)
         self.pos_encoding = get_sinusoid_encoding_table(maximum_position_encoding, hid_dim)
 
         self.dec_layers = [DecoderLayer(pf_dim, hid_dim, n_heads, dropout)
@@ -516,6 +562,22 @@ class Decoder(tf.keras.layers.Layer):
     
         return output, attention_weights
     
+""" tied output layer """
+class TiedOutputLayer(tf.keras.layers.Layer):
+    def __init__(self, embedding):
+        super(TiedOutputLayer, self).__init__()
+        # 임베딩 행렬을 전치해서 출력층 가중치로 쓰고, bias 만 따로 둔다.
+        self.embedding = embedding
+
+    def build(self, input_shape):
+        self.bias = self.add_weight(name='bias', shape=(self.embedding.input_dim,),
+                                    initializer='zeros')
+
+    def call(self, inputs):
+        # (batch_size, seq_len, hid_dim) x (hid_dim, n_vocab)
+        logits = tf.matmul(inputs, self.embedding.embeddings, transpose_b=True)
+        return logits + self.bias
+
 def create_masks(inp, tar):
     enc_padding_mask = create_padding_mask(inp)
     dec_padding_mask = create_padding_mask(inp)
@@ -532,17 +594,26 @@ class Transformer(tf.keras.Model):
 
     def __init__(self, n_enc_vocab, n_dec_vocab,
                  n_layers, pf_dim, hid_dim, n_heads,
-                 pe_input, pe_target, dropout):
+                 pe_input, pe_target, dropout, tie_embeddings=False):
         super(Transformer, self).__init__()
+        if tie_embeddings:
+            assert n_enc_vocab == n_dec_vocab, 'tied embeddings need a shared vocabulary'
+            embedding = tf.keras.layers.Embedding(n_dec_vocab, hid_dim)
+        else:
+            embedding = None
+
         self.encoder = Encoder(n_enc_vocab,
                                n_layers, pf_dim, hid_dim, n_heads,
-                               pe_input, dropout)
+                               pe_input, dropout, embedding)
 
         self.decoder = Decoder(n_dec_vocab,
                                n_layers, pf_dim, hid_dim, n_heads,
-                               pe_target, dropout)
+                               pe_target, dropout, embedding)
 
-        self.fin_output = tf.keras.layers.Dense(n_dec_vocab)
+        if tie_embeddings:
+            self.fin_output = TiedOutputLayer(embedding)
+        else:
+            self.fin_output = tf.keras.layers.Dense(n_dec_vocab)
     
     def call(self, inp, tar, training, enc_padding_mask, look_ahead_mask, dec_padding_mask):
         enc_output = self.encoder(inp, training, enc_padding_mask)
@@ -612,7 +683,8 @@ model = Transformer(
     n_heads     = n_heads,
     pe_input    = 512,
     pe_target   = 512,
-    dropout     = dropout)
+    dropout     = dropout,
+    tie_embeddings = SHARED_VOCAB and TIE_EMBEDDINGS)
 
 # tf.keras.utils.plot_model(
 #     model, to_file='transformer.png', show_shapes=True)
@@ -628,8 +700,12 @@ if ckpt_manager.latest_checkpoint:
     ckpt.restore(ckpt_manager.latest_checkpoint)
     print('Latest checkpoint restored!!')
 
-@tf.function
+@tf.function(reduce_retracing=True)
 def train_step(inp, tar):
+    # 데이터셋의 int16 / int32 id 를 디바이스에서 int64 로 바꾼다.
+    inp = tf.cast(inp, tf.int64)
+    tar = tf.cast(tar, tf.int64)
+
     tar_inp = tar[:, :-1]
     tar_real = tar[:, 1:]
 
@@ -650,17 +726,24 @@ def train_step(inp, tar):
     train_loss(loss)
     train_accuracy(accuracy_function(tar_real, predictions))
 
+# 패딩을 뺀 실제 토큰 수로 초당 처리량을 잰다.
+token_rate = TokenRate()
+
 for epoch in range(N_EPOCHS):
     train_loss.reset_states()
+    token_rate.reset()
     
-    with tqdm_notebook(total=len(dataset), desc=f"Train {epoch+1}") as pbar:
+    # bucket 모드에서는 배치 수를 미리 알 수 없다. (None)
+    with tqdm_notebook(total=num_batches(dataset), desc=f"Train {epoch+1}") as pbar:
         for (batch, (inp, tar)) in enumerate(dataset):
             train_step(inp, tar)
+            token_rate.update(inp, tar)
     
             pbar.update(1)
             pbar.set_postfix_str(f"Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}")
             
     # print(f'Epoch {epoch + 1} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
+    print(f'Epoch {epoch + 1} : {token_rate.result():.0f} tokens/sec')
     
 ckpt_save_path = ckpt_manager.save()
 print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
@@ -669,6 +752,8 @@ raw_src = raw_src.tolist()
 raw_trg = raw_trg.tolist()
 
 def evaluate(text):
+    # 학습 데이터와 같은 정규화를 거친다.
+    text = preprocess_eng(text)
     text = SRC_tokenizer.texts_to_sequences([text])
     text = tf.keras.preprocessing.sequence.pad_sequences(text, maxlen=ENCODER_LEN,
                                                          padding='post', truncating='post')
@@ -1,5 +1,4 @@
 import os
-import re
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -40,79 +39,77 @@ BUFFER_SIZE = 20000
 
 N_EPOCHS = 200
 
-import urllib3
-import zipfile
-import shutil
 import pandas as pd
 
+from cornell_corpus import fetch_corpus, extract_corpus, load_dialog_pairs_parallel
+from corpus_store import open_corpus_store
+from text_preprocessing import preprocess_eng, cached_preprocess, cache_hit_rate
+from tokenizer_utils import (batch_tokenizer, pad_ragged, save_tokenizer,
+                             compact_ids, vocab_coverage)
+from data_pipeline import (word_lengths, within_len, dedup_pairs, filter_pairs_by_len,
+                           reservoir_sample, sample_pairs, near_dedup, near_dedup_pairs)
+
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'http://www.cs.cornell.edu/~cristian/data/cornell_movie_dialogs_corpus.zip'
-filename = 'cornell_movie_dialogs_corpus.zip'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-with zipfile.ZipFile(zipfilename, 'r') as zip_ref:
-    zip_ref.extractall(path)
-
-# ! unzip cornell_movie_dialogs_corpus.zip
-path_to_movie_lines = '/content/cornell movie-dialogs corpus/movie_lines.txt'
-path_to_movie_conversations = '/content/cornell movie-dialogs corpus/movie_conversations.txt'
-
-# Option 1
-def preprocess_eng(sentence):
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    return sentence
+# 코퍼스는 로컬 캐시에 한 번만 내려받고, 이후 실행에서는 체크섬만 확인한다.
+# zip 파일은 압축을 풀지 않고 그대로 스트리밍해서 읽는다.
+zipfilename = fetch_corpus()
+
+# 처음 한 번만 파싱해서 바이너리 저장소로 만들고, 이후에는 memory-map 으로 바로 읽는다.
+corpus_store = open_corpus_store(zipfilename)
+
+# 1 보다 크면 대용량 코퍼스를 바이트 구간으로 나누어 여러 프로세스에서 전처리한다.
+N_INGEST_WORKERS = 0
+
+# 전처리 결과를 재사용하는 LRU 캐시의 최대 문장 수
+NORMALIZE_CACHE_SIZE = 1 << 18
+
+# 학습 데이터 샘플링 방식
+#   'random'     : train_df.sample(n=N_SAMPLES) (기존 방식)
+#   'full'       : 길이 조건을 만족하는 모든 쌍
+#   'reservoir'  : 수집 단계의 스트림에서 바로 N_SAMPLES 개를 뽑는다 (대용량 코퍼스)
+#   'stratified' : 문장 길이 구간별 비율을 유지하면서 N_SAMPLES 개를 뽑는다
+SAMPLE_MODE = 'random'
+N_SAMPLES   = 1024*8
+
+# 0 ~ 1 사이 값으로 설정하면 MinHash/LSH 로 추정한 Jaccard 유사도가 이 값 이상인
+# 거의 같은 질문, 답변을 제거한다. (None 이면 사용하지 않음)
+NEAR_DUP_THRESHOLD = None
+
+# 단어 집합 크기 상한. 빈도 상위 단어만 MAX_VOCAB_SIZE - 1 번까지 번호를 주고 나머지는 <unk> 로 바꾼다.
+# (None 이면 모든 단어 사용) python tokenizer_utils.py 로 크기별 OOV 비율과 출력층 속도를 비교할 수 있다.
+MAX_VOCAB_SIZE = None
 
 def load_preprocessed_data():
-    # dictionary of line id to text
-    id2line = {}
-    with open(path_to_movie_lines, errors='ignore') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        id2line[parts[0]] = parts[4]
+    # 같은 문장이 여러 번 나오므로 전처리 결과를 LRU 캐시에 저장해 재사용한다.
+    normalize = cached_preprocess(NORMALIZE_CACHE_SIZE)
+
+    if N_INGEST_WORKERS > 1:
+        corpus_dir = extract_corpus(zipfilename, os.getcwd())
+        pairs = zip(*load_dialog_pairs_parallel(corpus_dir, preprocess_eng, N_INGEST_WORKERS))
+    else:
+        # (질문, 답변) 쌍을 미리 파싱해 둔 저장소에서 읽어온다.
+        pairs = ((normalize(src_line), normalize(trg_line))
+                 for src_line, trg_line in corpus_store.iter_pairs())
+
+    # 앞에서 이미 나온 질문, 답변은 64비트 해시로 바로 걸러낸다. (처음 나온 쌍만 남긴다)
+    pairs = dedup_pairs(pairs)
+    if SAMPLE_MODE == 'reservoir':
+        # 코퍼스 전체를 메모리에 올리지 않고 스트림에서 바로 N_SAMPLES 개를 뽑는다.
+        pairs = filter_pairs_by_len(pairs, 4, 20)
+        if NEAR_DUP_THRESHOLD is not None:
+            # 샘플링 전에 거의 같은 질문, 답변을 걸러야 N_SAMPLES 개를 모두 채운다.
+            pairs = near_dedup_pairs(pairs, threshold=NEAR_DUP_THRESHOLD)
+        pairs = reservoir_sample(pairs, N_SAMPLES, seed=1234)
 
     processed_src, processed_trg = [], []
-    with open(path_to_movie_conversations, 'r') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        # get conversation in a list of line ID
-        conversation = [line[1:-1] for line in parts[3][1:-1].split(', ')]
-        for i in range(len(conversation) - 1):
-            processed_src.append(preprocess_eng(id2line[conversation[i]]))
-            processed_trg.append(preprocess_eng(id2line[conversation[i + 1]]))
+    for src_line, trg_line in pairs:
+        processed_src.append(src_line)
+        processed_trg.append(trg_line)
 
+    if N_INGEST_WORKERS <= 1:
+        print('Normalize cache :', normalize.cache_info())
+        print('Cache hit rate  : {:.1%}'.format(cache_hit_rate(normalize)))
     return processed_src, processed_trg
 
 # 인코딩 테스트
@@ -131,38 +128,26 @@ df1.rename(columns={0: "SRC"}, errors="raise", inplace=True)
 df2.rename(columns={0: "TRG"}, errors="raise", inplace=True)
 train_df = pd.concat([df1, df2], axis=1)
 
-train_df["src_len"] = ""
-train_df["trg_len"] = ""
+# 공백 기준 단어 수를 한 번에(벡터 연산으로) 계산한다.
+train_df["src_len"] = word_lengths(train_df['SRC'])
+train_df["trg_len"] = word_lengths(train_df['TRG'])
 train_df.head()
 
-for idx in range(len(train_df['SRC'])):
-    # initialize string
-    text_eng = str(train_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    train_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(train_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    train_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["TRG"])
+# 중복된 질문, 답변은 load_preprocessed_data() 에서 이미 제거되었다.
 print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
 
 # 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (4 < train_df['src_len']) & (train_df['src_len'] <= 20) & (4 < train_df['trg_len']) & (train_df['trg_len'] <=20)
+is_within_len = within_len(train_df, 4, 20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
 train_df = train_df[is_within_len]
 
-dataset_df_8096 = train_df.sample(n=1024*8, # number of items from axis to return.
-          random_state=1234) # seed for random number generator for reproducibility
+if NEAR_DUP_THRESHOLD is not None and SAMPLE_MODE != 'reservoir':
+    # 거의 같은 질문, 답변을 제거한다. (reservoir 는 load_preprocessed_data() 에서 이미 제거)
+    train_df = near_dedup(train_df, threshold=NEAR_DUP_THRESHOLD)
+    print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
+
+dataset_df_8096 = sample_pairs(train_df, N_SAMPLES, # number of items from axis to return.
+          mode=SAMPLE_MODE, seed=1234) # seed for random number generator for reproducibility
 
 print('Translation Pair :',len(dataset_df_8096)) # 리뷰 개수 출력
 
@@ -176,12 +161,25 @@ filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
 oov_token = '<unk>'
 
 # Define tokenizer
-SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
+SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
+TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
 
 SRC_tokenizer.fit_on_texts(src_sentence)
 TRG_tokenizer.fit_on_texts(trg_sentence)
 
+if MAX_VOCAB_SIZE:
+    # 상위 단어만 남겼을 때 학습 데이터에서 <unk> 로 바뀌는 토큰의 비율
+    for name, fitted in (('SRC', SRC_tokenizer), ('TRG', TRG_tokenizer)):
+        coverage = vocab_coverage(fitted)
+        print('{} coverage : {:.2%}, OOV : {:.2%}'.format(
+            name, coverage['token_coverage'], coverage['oov_rate']))
+
+# 학습에 쓴 tokenizer 는 단어 집합과 설정만 남긴 읽기 전용 tokenizer 로 바꾸어 체크포인트 폴더에 저장한다.
+# 추론할 때는 tokenizer_utils.load_tokenizer(os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json')) 로 코퍼스 없이 바로 읽어온다.
+TOKENIZER_DIR = "./checkpoints"
+SRC_tokenizer = save_tokenizer(SRC_tokenizer, os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json'))
+TRG_tokenizer = save_tokenizer(TRG_tokenizer, os.path.join(TOKENIZER_DIR, 'TRG_tokenizer.json'))
+
 n_enc_vocab = len(SRC_tokenizer.word_index) + 1
 n_dec_vocab = len(TRG_tokenizer.word_index) + 1
 
@@ -214,15 +212,22 @@ for line in lines:
     print("ids_2_txt :", ids_2_txt[0],"\n")
     
 # 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
-tokenized_inputs  = SRC_tokenizer.texts_to_sequences(src_sentence)
-tokenized_outputs = TRG_tokenizer.texts_to_sequences(trg_sentence)
+# 문장 목록 전체를 한 번에 정수 인코딩한다. (texts_to_sequences 와 같은 번호의 RaggedTensor)
+SRC_encoder = batch_tokenizer(SRC_tokenizer)
+TRG_encoder = batch_tokenizer(TRG_tokenizer)
+
+tokenized_inputs  = SRC_encoder(src_sentence)
+tokenized_outputs = TRG_encoder(trg_sentence)
 
 # 패딩
-tkn_sources = tf.keras.preprocessing.sequence.pad_sequences(tokenized_inputs,  maxlen=ENCODER_LEN, padding='post', truncating='post')
-tkn_targets = tf.keras.preprocessing.sequence.pad_sequences(tokenized_outputs, maxlen=DECODER_LEN, padding='post', truncating='post')
+tkn_sources = pad_ragged(tokenized_inputs,  ENCODER_LEN, truncating='post')
+tkn_targets = pad_ragged(tokenized_outputs, DECODER_LEN, truncating='post')
 
-tkn_sources = tf.cast(tkn_sources, dtype=tf.int64)
-tkn_targets = tf.cast(tkn_targets, dtype=tf.int64)
+# 데이터셋 캐시와 디바이스 전송에는 id 를 int64 대신 int32 로 저장한다.
+# (TPU 는 int32 가 기본 정수형이라 int16 은 쓰지 않는다)
+tkn_sources, tkn_targets = compact_ids(
+    tkn_sources, tkn_targets, vocab_size=max(n_enc_vocab, n_dec_vocab), dtype=tf.int32)
+print('토큰 저장 dtype :', tkn_sources.dtype.name, '(int64 의 1/{})'.format(8 // tkn_sources.dtype.size))
 
 print('질문 데이터의 크기(shape) :', tkn_sources.shape)
 print('답변 데이터의 크기(shape) :', tkn_targets.shape)
@@ -701,6 +706,8 @@ raw_src = raw_src.tolist()
 raw_trg = raw_trg.tolist()
 
 def evaluate(text):
+    # 학습 데이터와 같은 정규화를 거친다.
+    text = preprocess_eng(text)
     text = SRC_tokenizer.texts_to_sequences([text])
     text = tf.keras.preprocessing.sequence.pad_sequences(text, maxlen=ENCODER_LEN,
                                                          padding='post', truncating='post')
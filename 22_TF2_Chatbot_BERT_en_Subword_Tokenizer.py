@@ -1,13 +1,10 @@
 import os
-import re
 import time
 import numpy as np
 import matplotlib.pyplot as plt
 import tensorflow as tf
 import unicodedata
 
-import tensorflow_datasets as tfds
-
 from tqdm import tqdm, tqdm_notebook, trange
 
 from tensorflow.keras.layers import Dense, Input
@@ -25,79 +22,94 @@ BUFFER_SIZE = 20000
 
 N_EPOCHS = 20
 
-import urllib3
-import zipfile
-import shutil
 import pandas as pd
 
+from cornell_corpus import fetch_corpus, extract_corpus, load_dialog_pairs_parallel
+from corpus_store import open_corpus_store
+from text_preprocessing import preprocess_eng, cached_preprocess, cache_hit_rate
+from tokenizer_utils import (build_subword_tokenizer, FastSubwordEncoder, batch_tokenizer, pack_pairs, pack_sequences,
+                             compact_ids, SpecialTokenizer, PAD, CLS, SEP, MASK)
+from data_pipeline import (word_lengths, within_len, dedup_pairs, filter_pairs_by_len,
+                           reservoir_sample, sample_pairs, near_dedup, near_dedup_pairs)
+from token_shards import export_token_shards, read_token_shards
+from bucketing import (bucket_by_length, num_batches, padding_report, print_padding_report, TokenRate,
+                       content_length)
+
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'http://www.cs.cornell.edu/~cristian/data/cornell_movie_dialogs_corpus.zip'
-filename = 'cornell_movie_dialogs_corpus.zip'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-with zipfile.ZipFile(zipfilename, 'r') as zip_ref:
-    zip_ref.extractall(path)
-
-# ! unzip cornell_movie_dialogs_corpus.zip
-path_to_movie_lines = '/content/cornell movie-dialogs corpus/movie_lines.txt'
-path_to_movie_conversations = '/content/cornell movie-dialogs corpus/movie_conversations.txt'
-
-# Option 1
-def preprocess_eng(sentence):
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    return sentence
+# 코퍼스는 로컬 캐시에 한 번만 내려받고, 이후 실행에서는 체크섬만 확인한다.
+# zip 파일은 압축을 풀지 않고 그대로 스트리밍해서 읽는다.
+zipfilename = fetch_corpus()
+
+# 처음 한 번만 파싱해서 바이너리 저장소로 만들고, 이후에는 memory-map 으로 바로 읽는다.
+corpus_store = open_corpus_store(zipfilename)
+
+# 1 보다 크면 대용량 코퍼스를 바이트 구간으로 나누어 여러 프로세스에서 전처리한다.
+N_INGEST_WORKERS = 0
+
+# 전처리 결과를 재사용하는 LRU 캐시의 최대 문장 수
+NORMALIZE_CACHE_SIZE = 1 << 18
+
+# 학습 데이터 샘플링 방식
+#   'random'     : train_df.sample(n=N_SAMPLES) (기존 방식)
+#   'full'       : 길이 조건을 만족하는 모든 쌍
+#   'reservoir'  : 수집 단계의 스트림에서 바로 N_SAMPLES 개를 뽑는다 (대용량 코퍼스)
+#   'stratified' : 문장 길이 구간별 비율을 유지하면서 N_SAMPLES 개를 뽑는다
+SAMPLE_MODE = 'random'
+N_SAMPLES   = 1024*8
+
+# 0 ~ 1 사이 값으로 설정하면 MinHash/LSH 로 추정한 Jaccard 유사도가 이 값 이상인
+# 거의 같은 질문, 답변을 제거한다. (None 이면 사용하지 않음)
+NEAR_DUP_THRESHOLD = None
+
+# True 이면 정수 인코딩 결과를 압축된 TFRecord 샤드로 한 번 내보내고, 학습은 샤드를 병렬로 읽어서 한다.
+# (데이터셋이 그래프에 상수로 들어가지 않고, 메모리보다 큰 데이터도 스트리밍할 수 있다)
+USE_TOKEN_SHARDS = False
+
+# True 이면 한 행(ENCODER_LEN)에 여러 (질문, 답변) 쌍을 이어 붙여서 학습한다.
+# 쌍마다 위치 번호를 0 부터 다시 매기고, 어텐션은 같은 쌍 안에서만 보도록 마스크를 만든다.
+PACK_SEQUENCES = False
+
+# 'fixed'  : 모든 문장을 ENCODER_LEN / DECODER_LEN 까지 패딩한 배치 (기존 방식)
+# 'bucket' : 길이가 비슷한 문장끼리 배치를 만들고, 배치마다 가장 긴 문장 길이까지만 남긴다.
+# python bucketing.py 로 패딩 비율과 초당 토큰 수를 비교할 수 있다.
+BATCH_MODE   = 'fixed'
+# 'bucket' 일 때 배치 하나의 토큰 수 (None 이면 길이와 상관없이 BATCH_SIZE 개씩)
+TOKEN_BUDGET = None
+# 시작할 때 앞쪽 배치 PADDING_REPORT_BATCHES 개로 패딩 비율을 출력한다. (None 이면 출력하지 않는다)
+# 데이터셋 전체를 미리 읽지 않도록 일부 배치만 확인한다.
+PADDING_REPORT_BATCHES = None
 
 def load_preprocessed_data():
-    # dictionary of line id to text
-    id2line = {}
-    with open(path_to_movie_lines, errors='ignore') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        id2line[parts[0]] = parts[4]
+    # 같은 문장이 여러 번 나오므로 전처리 결과를 LRU 캐시에 저장해 재사용한다.
+    normalize = cached_preprocess(NORMALIZE_CACHE_SIZE)
+
+    if N_INGEST_WORKERS > 1:
+        corpus_dir = extract_corpus(zipfilename, os.getcwd())
+        pairs = zip(*load_dialog_pairs_parallel(corpus_dir, preprocess_eng, N_INGEST_WORKERS))
+    else:
+        # (질문, 답변) 쌍을 미리 파싱해 둔 저장소에서 읽어온다.
+        pairs = ((normalize(src_line), normalize(trg_line))
+                 for src_line, trg_line in corpus_store.iter_pairs())
+
+    # 앞에서 이미 나온 질문, 답변은 64비트 해시로 바로 걸러낸다. (처음 나온 쌍만 남긴다)
+    pairs = dedup_pairs(pairs)
+    if SAMPLE_MODE == 'reservoir':
+        # 코퍼스 전체를 메모리에 올리지 않고 스트림에서 바로 N_SAMPLES 개를 뽑는다.
+        pairs = filter_pairs_by_len(pairs, 4, 20)
+        if NEAR_DUP_THRESHOLD is not None:
+            # 샘플링 전에 거의 같은 질문, 답변을 걸러야 N_SAMPLES 개를 모두 채운다.
+            pairs = near_dedup_pairs(pairs, threshold=NEAR_DUP_THRESHOLD)
+        pairs = reservoir_sample(pairs, N_SAMPLES, seed=1234)
 
     processed_src, processed_trg = [], []
-    with open(path_to_movie_conversations, 'r') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        # get conversation in a list of line ID
-        conversation = [line[1:-1] for line in parts[3][1:-1].split(', ')]
-        for i in range(len(conversation) - 1):
-            processed_src.append(preprocess_eng(id2line[conversation[i]]))
-            processed_trg.append(preprocess_eng(id2line[conversation[i + 1]]))
+    for src_line, trg_line in pairs:
+        processed_src.append(src_line)
+        processed_trg.append(trg_line)
 
+    if N_INGEST_WORKERS <= 1:
+        print('Normalize cache :', normalize.cache_info())
+        print('Cache hit rate  : {:.1%}'.format(cache_hit_rate(normalize)))
     return processed_src, processed_trg
 
 # 인코딩 테스트
@@ -116,38 +128,26 @@ df1.rename(columns={0: "SRC"}, errors="raise", inplace=True)
 df2.rename(columns={0: "TRG"}, errors="raise", inplace=True)
 train_df = pd.concat([df1, df2], axis=1)
 
-train_df["src_len"] = ""
-train_df["trg_len"] = ""
+# 공백 기준 단어 수를 한 번에(벡터 연산으로) 계산한다.
+train_df["src_len"] = word_lengths(train_df['SRC'])
+train_df["trg_len"] = word_lengths(train_df['TRG'])
 train_df.head()
 
-for idx in range(len(train_df['SRC'])):
-    # initialize string
-    text_eng = str(train_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    train_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(train_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    train_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["TRG"])
+# 중복된 질문, 답변은 load_preprocessed_data() 에서 이미 제거되었다.
 print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
 
 # 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (4 < train_df['src_len']) & (train_df['src_len'] <= 20) & (4 < train_df['trg_len']) & (train_df['trg_len'] <=20)
+is_within_len = within_len(train_df, 4, 20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
 train_df = train_df[is_within_len]
 
-dataset_df_8096 = train_df.sample(n=1024*8, # number of items from axis to return.
-          random_state=1234) # seed for random number generator for reproducibility
+if NEAR_DUP_THRESHOLD is not None and SAMPLE_MODE != 'reservoir':
+    # 거의 같은 질문, 답변을 제거한다. (reservoir 는 load_preprocessed_data() 에서 이미 제거)
+    train_df = near_dedup(train_df, threshold=NEAR_DUP_THRESHOLD)
+    print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
+
+dataset_df_8096 = sample_pairs(train_df, N_SAMPLES, # number of items from axis to return.
+          mode=SAMPLE_MODE, seed=1234) # seed for random number generator for reproducibility
 
 print('Translation Pair :',len(dataset_df_8096)) # 리뷰 개수 출력
 
@@ -162,25 +162,35 @@ print(raw_trg[:5])
 print('Translation Pair :',len(raw_src)) # 리뷰 개수 출력
 
 # 서브워드텍스트인코더를 사용하여 질문과 답변을 모두 포함한 단어 집합(Vocabulary) 생성
-SRC_tokenizer = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(
+# 같은 코퍼스로 만든 단어 집합은 캐시에 저장해 두고 다음 실행에서는 파일에서 바로 읽어온다.
+SRC_tokenizer = build_subword_tokenizer(
     raw_src, target_vocab_size=2**13)
 
 # 서브워드텍스트인코더를 사용하여 질문과 답변을 모두 포함한 단어 집합(Vocabulary) 생성
-TRG_tokenizer = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(
+TRG_tokenizer = build_subword_tokenizer(
     raw_trg, target_vocab_size=2**13)
 
-# 시작 토큰과 종료 토큰에 대한 정수 부여.
-CLS_SRC, SEP_SRC, MASK_SRC = [SRC_tokenizer.vocab_size], [SRC_tokenizer.vocab_size + 1] , [SRC_tokenizer.vocab_size + 2]
+# trie 기반 인코더로 감싸서 encode 를 빠르게 한다. (같은 단어 집합, 같은 번호)
+SRC_tokenizer = FastSubwordEncoder(SRC_tokenizer)
+TRG_tokenizer = FastSubwordEncoder(TRG_tokenizer)
+
+# 특수 토큰에 대한 정수 부여. (단어 집합 바로 뒤 번호, 패딩은 0 번)
+# 답변에는 SEP 토큰만 쓰이므로 TRG 단어 집합에는 SEP 만 더한다.
+SRC_tokenizer = SpecialTokenizer(SRC_tokenizer, [PAD, CLS, SEP, MASK])
+TRG_tokenizer = SpecialTokenizer(TRG_tokenizer, [PAD, SEP])
 
-CLS_TRG, SEP_TRG, MASK_TRG = [TRG_tokenizer.vocab_size], [TRG_tokenizer.vocab_size + 1] , [TRG_tokenizer.vocab_size + 2]
+CLS_SRC, SEP_SRC, MASK_SRC = [SRC_tokenizer.token_id(CLS)], [SRC_tokenizer.token_id(SEP)], [SRC_tokenizer.token_id(MASK)]
 
-# CLS 토큰과 SEP 토큰, MASK 토큰을 고려하여 단어 집합의 크기를 + 3
-n_enc_vocab = SRC_tokenizer.vocab_size + 3
-n_dec_vocab = TRG_tokenizer.vocab_size + 3
+SEP_TRG = [TRG_tokenizer.token_id(SEP)]
 
-print('TRG CLS 토큰 번호        :',CLS_TRG)
+# 특수 토큰까지 포함한 정확한 단어 집합의 크기
+n_enc_vocab = SRC_tokenizer.vocab_size
+n_dec_vocab = TRG_tokenizer.vocab_size
+
+print('SRC CLS 토큰 번호        :',CLS_SRC)
+print('SRC SEP 토큰 번호        :',SEP_SRC)
+print('SRC MASK 토큰 번호       :',MASK_SRC)
 print('TRG SEP 토큰 번호        :',SEP_TRG)
-print('TRG MASK 토큰 번호       :',MASK_TRG)
 print('Encoder 단어 집합의 크기 :',n_enc_vocab)
 print('Decoder 단어 집합의 크기 :',n_dec_vocab)
 
@@ -202,33 +212,43 @@ for ts in txt_2_ids:
     print ('{} ----> {}'.format(ts, SRC_tokenizer.decode([ts])))
 
 # 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
-tkn_sources   = []
-tkn_segments = []
-tkn_targets   = []
-
-for (sentence1, sentence2) in zip(raw_src, raw_trg):
-    sentence1 = CLS_SRC + SRC_tokenizer.encode(sentence1) + SEP_TRG
-    sentence2 = TRG_tokenizer.encode(sentence2) + SEP_TRG
-
-    indexed_src_tkns = sentence1 + MASK_SRC * (ENCODER_LEN - len(sentence1))
-    indexed_seg_tkns = [0]*len(sentence1) + [1]*len(sentence2) + [0]*(ENCODER_LEN - len(sentence1)-len(sentence2))
-    indexed_trg_tkns = [0]*len(sentence1) + sentence2 + [0]*(ENCODER_LEN - len(sentence1)-len(sentence2))
-
-    tkn_sources.append(indexed_src_tkns)
-    tkn_targets.append(indexed_trg_tkns)
-    tkn_segments.append(indexed_seg_tkns)
-    
-tensors_src   = tf.cast(tkn_sources, dtype=tf.int64)
-tensors_trg   = tf.cast(tkn_targets, dtype=tf.int64)
-tensors_embed = tf.cast(tkn_segments, dtype=tf.int64)
-
+# 문장 목록 전체를 한 번에 정수 인코딩한다.
+SRC_encoder = batch_tokenizer(SRC_tokenizer)
+TRG_encoder = batch_tokenizer(TRG_tokenizer)
+
+encoded_src = SRC_encoder(raw_src, prefix=CLS_SRC, suffix=SEP_SRC)
+encoded_trg = TRG_encoder(raw_trg, suffix=SEP_TRG)
+
+# 질문 뒤에 답변이 오도록 source / target / segment 를 한 번에 만든다.
+# 질문과 답변을 합친 길이가 ENCODER_LEN 을 넘는 쌍은 뺀다. (overflow='truncate' 이면 답변의 마지막 토큰은 남기고 잘라서 넣는다)
+tensors_src, tensors_trg, tensors_embed, is_packed = pack_pairs(
+    encoded_src, encoded_trg, ENCODER_LEN, src_pad_id=MASK_SRC[0], overflow='drop')
+
+if PACK_SEQUENCES:
+    # 쌍의 길이(질문 + 답변)는 target 행의 마지막 토큰 위치로 알 수 있다.
+    n_pairs = len(tensors_src)
+    (tensors_src, tensors_trg, tensors_embed), example_ids, positions = pack_sequences(
+        [tensors_src, tensors_trg, tensors_embed], content_length(tensors_trg), pad_ids=[MASK_SRC[0], 0, 0])
+    print('{} 개의 쌍을 {} 개의 행으로 묶었다.'.format(n_pairs, len(tensors_src)))
+
+# 데이터셋 캐시와 디바이스 전송에는 id 를 int64 대신 int16 / int32 로 저장한다.
+# (train_step 에서 디바이스로 옮겨진 뒤 int64 로 바꾼다)
+tensors_src, tensors_trg, tensors_embed = compact_ids(
+    tensors_src, tensors_trg, tensors_embed, vocab_size=max(n_enc_vocab, n_dec_vocab))
+if PACK_SEQUENCES:
+    # 토큰 샤드는 모든 feature 를 한 dtype 으로 저장하므로 토큰 id 와 같은 dtype 을 쓴다.
+    example_ids, positions = compact_ids(example_ids, positions, vocab_size=ENCODER_LEN + 1,
+                                         dtype=tensors_src.dtype)
+print('토큰 저장 dtype :', tensors_src.dtype.name, '(int64 의 1/{})'.format(8 // tensors_src.dtype.size))
+
+print('길이를 넘어 제외된 쌍     :', int(tf.reduce_sum(tf.cast(~is_packed, tf.int32))))
 print('질문 데이터의 크기(shape) :', tensors_src.shape)
 print('답변 데이터의 크기(shape) :', tensors_trg.shape)
 
 # 0번째 샘플을 임의로 출력
-print(tkn_sources[0])
-print(tkn_targets[0])
-print(tkn_segments[0])
+print(tensors_src[0])
+print(tensors_trg[0])
+print(tensors_embed[0])
 
 n_seg_type = 2
 n_layers  = 2     # 6
@@ -237,13 +257,33 @@ pf_dim    = 1024
 n_heads   = 8
 dropout   = 0.3
 
-dataset = tf.data.Dataset.from_tensor_slices((tensors_src, tensors_trg, tensors_embed))
+features = {'inputs': tensors_src, 'targets': tensors_trg, 'segments': tensors_embed}
+if PACK_SEQUENCES:
+    features.update(example_ids=example_ids, positions=positions)
+
+if USE_TOKEN_SHARDS:
+    # 같은 데이터는 한 번만 내보낸다. (캐시 폴더의 shards/<해시> 아래)
+    shard_dir = export_token_shards(features)
+    print('토큰 샤드 :', shard_dir)
+    dataset = read_token_shards(shard_dir)
+else:
+    dataset = tf.data.Dataset.from_tensor_slices(tuple(features.values()))
+    dataset = dataset.cache()
 
-dataset = dataset.cache()
 dataset = dataset.shuffle(BUFFER_SIZE)
-dataset = dataset.batch(BATCH_SIZE)
+if BATCH_MODE == 'bucket':
+    # 배치의 패딩은 가장 긴 문장 길이(8 의 배수)까지만 남긴다.
+    dataset = bucket_by_length(dataset, BATCH_SIZE, trim_by=(1,) * len(dataset.element_spec),
+                               token_budget=TOKEN_BUDGET)
+else:
+    dataset = dataset.batch(BATCH_SIZE)
 dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
+# 패딩이 차지하는 비율
+if PADDING_REPORT_BATCHES:
+    print_padding_report(BATCH_MODE, padding_report(dataset, components=(1,),
+                                                    max_batches=PADDING_REPORT_BATCHES))
+
 
 """ attention pad mask """
 def create_padding_mask(seq):
@@ -251,6 +291,13 @@ def create_padding_mask(seq):
     # (batch_size, 1, 1, key의 문장 길이)
     return seq[:, tf.newaxis, tf.newaxis, :]
 
+""" attention mask of packed rows """
+def create_block_mask(example_ids):
+    # 서로 다른 쌍(example_ids 가 다른 위치)끼리는 어텐션하지 않는다.
+    mask = tf.math.not_equal(example_ids[:, :, tf.newaxis], example_ids[:, tf.newaxis, :])
+    # (batch_size, 1, query의 문장 길이, key의 문장 길이)
+    return tf.cast(mask, tf.float32)[:, tf.newaxis, :, :]
+
 """ scale dot product attention """
 def ScaledDotProductAttention(query, key, value, mask):
     """Calculate the attention weights.
@@ -413,13 +460,14 @@ class Encoder(tf.keras.layers.Layer):
 
         self.dropout1 = tf.keras.layers.Dropout(dropout)
 
-    def call(self, x, training, padding_mask, segments):
+    def call(self, x, training, padding_mask, segments, positions=None):
         seq_len = tf.shape(x)[1]
 
         # adding embedding and position encoding.
         tok_emb = self.tok_embedding(x)  # (batch_size, input_seq_len, hid_dim)
         
-        positions = tf.range(start=0, limit=seq_len, delta=1)
+        if positions is None:
+            positions = tf.range(start=0, limit=seq_len, delta=1)
         pos_emb = self.pos_embedding(positions)
         seg_emb = self.seg_embedding(segments)
         
@@ -446,8 +494,8 @@ class BERT(tf.keras.Model):
 
         self.fin_output = tf.keras.layers.Dense(n_dec_vocab)
     
-    def call(self, inp, segments, training, enc_padding_mask):
-        enc_output = self.encoder(inp, training, enc_padding_mask, segments)
+    def call(self, inp, segments, training, enc_padding_mask, positions=None):
+        enc_output = self.encoder(inp, training, enc_padding_mask, segments, positions)
 
         final_output = self.fin_output(enc_output)
 
@@ -527,13 +575,21 @@ if ckpt_manager.latest_checkpoint:
     ckpt.restore(ckpt_manager.latest_checkpoint)
     print('Latest checkpoint restored!!')
 
-@tf.function
-def train_step(inp, tar, segments):
+@tf.function(reduce_retracing=True)
+def train_step(inp, tar, segments, example_ids=None, positions=None):
+    # 데이터셋의 int16 / int32 id 를 디바이스에서 int64 로 바꾼다.
+    inp = tf.cast(inp, tf.int64)
+    tar = tf.cast(tar, tf.int64)
+    segments = tf.cast(segments, tf.int64)
 
     enc_padding_mask = create_padding_mask(inp)
+    if example_ids is not None:
+        # 여러 쌍을 묶은 행 : 같은 쌍 안에서만 어텐션하고, 위치 번호는 쌍마다 0 부터 시작한다.
+        enc_padding_mask = tf.maximum(enc_padding_mask, create_block_mask(example_ids))
+        positions = tf.cast(positions, tf.int64)
 
     with tf.GradientTape() as tape:
-        predictions = model(inp, segments, True, enc_padding_mask)
+        predictions = model(inp, segments, True, enc_padding_mask, positions)
         loss = loss_function(tar, predictions)
 
     gradients = tape.gradient(loss, model.trainable_variables)
@@ -542,17 +598,24 @@ def train_step(inp, tar, segments):
     train_loss(loss)
     train_accuracy(accuracy_function(tar, predictions))
 
+# 패딩을 뺀 실제 토큰 수로 초당 처리량을 잰다.
+token_rate = TokenRate()
+
 for epoch in range(N_EPOCHS):
     train_loss.reset_states()
+    token_rate.reset()
     
-    with tqdm_notebook(total=len(dataset), desc=f"Train {epoch+1}") as pbar:
-        for (batch, (inp, tar, seg)) in enumerate(dataset):
-            train_step(inp, tar, seg)
+    # bucket 모드에서는 배치 수를 미리 알 수 없다. (None)
+    with tqdm_notebook(total=num_batches(dataset), desc=f"Train {epoch+1}") as pbar:
+        for (batch, (inp, tar, seg, *packing)) in enumerate(dataset):
+            train_step(inp, tar, seg, *packing)
+            token_rate.update(tar)
     
             pbar.update(1)
             pbar.set_postfix_str(f"Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}")
             
     # print(f'Epoch {epoch + 1} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
+    print(f'Epoch {epoch + 1} : {token_rate.result():.0f} tokens/sec')
     
 ckpt_save_path = ckpt_manager.save()
 print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
@@ -560,7 +623,8 @@ print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
 # Evaluation is on working
 """
 def evaluate(text):
-    text = preprocess_sentence(text)
+    # 학습 데이터와 같은 정규화를 거친다.
+    text = preprocess_eng(text)
 
     encoder_input = tf.expand_dims(SRC_tokenizer.encode(text), axis=0)
 
@@ -597,16 +661,11 @@ def evaluate(text):
 def predict(text):
     prediction = evaluate(text)
 
-    predicted_sentence = TRG_tokenizer.decode(
-        [i for i in prediction if i < TRG_tokenizer.vocab_size])
+    # 패딩과 특수 토큰은 decode 에서 한 번에 걸러진다.
+    predicted_sentence = TRG_tokenizer.decode(prediction)
     
     return predicted_sentence
 
-def preprocess_sentence(sentence):
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = sentence.strip()
-    return sentence
-
 for idx in (11, 21, 31, 41, 51):
     print("Input        :", raw_src[idx])
     print("Prediction   :", predict(raw_src[idx]))
@@ -1,5 +1,4 @@
 import os
-import re
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,79 +22,104 @@ BUFFER_SIZE = 20000
 
 N_EPOCHS = 20
 
-import urllib3
-import zipfile
-import shutil
 import pandas as pd
 
+from cornell_corpus import fetch_corpus, extract_corpus, load_dialog_pairs_parallel
+from corpus_store import open_corpus_store
+from text_preprocessing import preprocess_eng, cached_preprocess, cache_hit_rate
+from tokenizer_utils import (batch_tokenizer, pack_pairs, pack_sequences, save_tokenizer,
+                             compact_ids, vocab_coverage, SpecialTokenizer, PAD, CLS, SEP)
+from byte_bpe import build_byte_bpe
+from data_pipeline import (word_lengths, within_len, dedup_pairs, filter_pairs_by_len,
+                           reservoir_sample, sample_pairs, near_dedup, near_dedup_pairs)
+from token_shards import export_token_shards, read_token_shards
+from bucketing import (bucket_by_length, num_batches, padding_report, print_padding_report, TokenRate,
+                       content_length)
+
 pd.set_option('display.max_colwidth', None)
 
-http = urllib3.PoolManager()
-url = 'http://www.cs.cornell.edu/~cristian/data/cornell_movie_dialogs_corpus.zip'
-filename = 'cornell_movie_dialogs_corpus.zip'
-path = os.getcwd()
-zipfilename = os.path.join(path, filename)
-with http.request('GET', url, preload_content=False) as r, open(zipfilename, 'wb') as out_file:       
-    shutil.copyfileobj(r, out_file)
-
-with zipfile.ZipFile(zipfilename, 'r') as zip_ref:
-    zip_ref.extractall(path)
-
-# ! unzip cornell_movie_dialogs_corpus.zip
-path_to_movie_lines = '/content/cornell movie-dialogs corpus/movie_lines.txt'
-path_to_movie_conversations = '/content/cornell movie-dialogs corpus/movie_conversations.txt'
-
-# Option 1
-def preprocess_eng(sentence):
-    sentence = sentence.lower().strip()
-    # creating a space between a word and the punctuation following it
-    # eg: "he is a boy." => "he is a boy ."
-    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
-    sentence = re.sub(r'[" "]+', " ", sentence)
-    # removing contractions
-    sentence = re.sub(r"i'm", "i am", sentence)
-    sentence = re.sub(r"he's", "he is", sentence)
-    sentence = re.sub(r"she's", "she is", sentence)
-    sentence = re.sub(r"it's", "it is", sentence)
-    sentence = re.sub(r"that's", "that is", sentence)
-    sentence = re.sub(r"what's", "that is", sentence)
-    sentence = re.sub(r"where's", "where is", sentence)
-    sentence = re.sub(r"how's", "how is", sentence)
-    sentence = re.sub(r"\'ll", " will", sentence)
-    sentence = re.sub(r"\'ve", " have", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"\'d", " would", sentence)
-    sentence = re.sub(r"\'re", " are", sentence)
-    sentence = re.sub(r"won't", "will not", sentence)
-    sentence = re.sub(r"can't", "cannot", sentence)
-    sentence = re.sub(r"n't", " not", sentence)
-    sentence = re.sub(r"n'", "ng", sentence)
-    sentence = re.sub(r"'bout", "about", sentence)
-    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
-    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
-    sentence = sentence.strip()
-    return sentence
+# 코퍼스는 로컬 캐시에 한 번만 내려받고, 이후 실행에서는 체크섬만 확인한다.
+# zip 파일은 압축을 풀지 않고 그대로 스트리밍해서 읽는다.
+zipfilename = fetch_corpus()
+
+# 처음 한 번만 파싱해서 바이너리 저장소로 만들고, 이후에는 memory-map 으로 바로 읽는다.
+corpus_store = open_corpus_store(zipfilename)
+
+# 1 보다 크면 대용량 코퍼스를 바이트 구간으로 나누어 여러 프로세스에서 전처리한다.
+N_INGEST_WORKERS = 0
+
+# 전처리 결과를 재사용하는 LRU 캐시의 최대 문장 수
+NORMALIZE_CACHE_SIZE = 1 << 18
+
+# 학습 데이터 샘플링 방식
+#   'random'     : train_df.sample(n=N_SAMPLES) (기존 방식)
+#   'full'       : 길이 조건을 만족하는 모든 쌍
+#   'reservoir'  : 수집 단계의 스트림에서 바로 N_SAMPLES 개를 뽑는다 (대용량 코퍼스)
+#   'stratified' : 문장 길이 구간별 비율을 유지하면서 N_SAMPLES 개를 뽑는다
+SAMPLE_MODE = 'random'
+N_SAMPLES   = 1024*8
+
+# 0 ~ 1 사이 값으로 설정하면 MinHash/LSH 로 추정한 Jaccard 유사도가 이 값 이상인
+# 거의 같은 질문, 답변을 제거한다. (None 이면 사용하지 않음)
+NEAR_DUP_THRESHOLD = None
+
+# 단어 집합 크기 상한. 빈도 상위 단어만 MAX_VOCAB_SIZE - 1 번까지 번호를 주고 나머지는 <unk> 로 바꾼다.
+# (None 이면 모든 단어 사용) python tokenizer_utils.py 로 크기별 OOV 비율과 출력층 속도를 비교할 수 있다.
+MAX_VOCAB_SIZE = None
+
+# True 이면 단어 단위 tokenizer 대신 GPT-2 와 같은 byte-level BPE 로 토큰화한다. (단어 집합 크기 BPE_VOCAB_SIZE)
+# python byte_bpe.py 로 tokenizer 별 평균 문장 길이, OOV 비율, 초당 토큰 수를 비교할 수 있다.
+USE_BYTE_BPE   = False
+BPE_VOCAB_SIZE = 2**13
+
+# True 이면 정수 인코딩 결과를 압축된 TFRecord 샤드로 한 번 내보내고, 학습은 샤드를 병렬로 읽어서 한다.
+# (데이터셋이 그래프에 상수로 들어가지 않고, 메모리보다 큰 데이터도 스트리밍할 수 있다)
+USE_TOKEN_SHARDS = False
+
+# True 이면 한 행(ENCODER_LEN)에 여러 (질문, 답변) 쌍을 이어 붙여서 학습한다.
+# 쌍마다 위치 번호를 0 부터 다시 매기고, 어텐션은 같은 쌍 안에서만 보도록 마스크를 만든다.
+PACK_SEQUENCES = False
+
+# 'fixed'  : 모든 문장을 ENCODER_LEN / DECODER_LEN 까지 패딩한 배치 (기존 방식)
+# 'bucket' : 길이가 비슷한 문장끼리 배치를 만들고, 배치마다 가장 긴 문장 길이까지만 남긴다.
+# python bucketing.py 로 패딩 비율과 초당 토큰 수를 비교할 수 있다.
+BATCH_MODE   = 'fixed'
+# 'bucket' 일 때 배치 하나의 토큰 수 (None 이면 길이와 상관없이 BATCH_SIZE 개씩)
+TOKEN_BUDGET = None
+# 시작할 때 앞쪽 배치 PADDING_REPORT_BATCHES 개로 패딩 비율을 출력한다. (None 이면 출력하지 않는다)
+# 데이터셋 전체를 미리 읽지 않도록 일부 배치만 확인한다.
+PADDING_REPORT_BATCHES = None
 
 def load_preprocessed_data():
-    # dictionary of line id to text
-    id2line = {}
-    with open(path_to_movie_lines, errors='ignore') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        id2line[parts[0]] = parts[4]
+    # 같은 문장이 여러 번 나오므로 전처리 결과를 LRU 캐시에 저장해 재사용한다.
+    normalize = cached_preprocess(NORMALIZE_CACHE_SIZE)
+
+    if N_INGEST_WORKERS > 1:
+        corpus_dir = extract_corpus(zipfilename, os.getcwd())
+        pairs = zip(*load_dialog_pairs_parallel(corpus_dir, preprocess_eng, N_INGEST_WORKERS))
+    else:
+        # (질문, 답변) 쌍을 미리 파싱해 둔 저장소에서 읽어온다.
+        pairs = ((normalize(src_line), normalize(trg_line))
+                 for src_line, trg_line in corpus_store.iter_pairs())
+
+    # 앞에서 이미 나온 질문, 답변은 64비트 해시로 바로 걸러낸다. (처음 나온 쌍만 남긴다)
+    pairs = dedup_pairs(pairs)
+    if SAMPLE_MODE == 'reservoir':
+        # 코퍼스 전체를 메모리에 올리지 않고 스트림에서 바로 N_SAMPLES 개를 뽑는다.
+        pairs = filter_pairs_by_len(pairs, 4, 20)
+        if NEAR_DUP_THRESHOLD is not None:
+            # 샘플링 전에 거의 같은 질문, 답변을 걸러야 N_SAMPLES 개를 모두 채운다.
+            pairs = near_dedup_pairs(pairs, threshold=NEAR_DUP_THRESHOLD)
+        pairs = reservoir_sample(pairs, N_SAMPLES, seed=1234)
 
     processed_src, processed_trg = [], []
-    with open(path_to_movie_conversations, 'r') as file:
-        lines = file.readlines()
-    for line in lines:
-        parts = line.replace('\n', '').split(' +++$+++ ')
-        # get conversation in a list of line ID
-        conversation = [line[1:-1] for line in parts[3][1:-1].split(', ')]
-        for i in range(len(conversation) - 1):
-            processed_src.append(preprocess_eng(id2line[conversation[i]]))
-            processed_trg.append(preprocess_eng(id2line[conversation[i + 1]]))
+    for src_line, trg_line in pairs:
+        processed_src.append(src_line)
+        processed_trg.append(trg_line)
 
+    if N_INGEST_WORKERS <= 1:
+        print('Normalize cache :', normalize.cache_info())
+        print('Cache hit rate  : {:.1%}'.format(cache_hit_rate(normalize)))
     return processed_src, processed_trg
 
 # 인코딩 테스트
@@ -114,60 +138,77 @@ df1.rename(columns={0: "SRC"}, errors="raise", inplace=True)
 df2.rename(columns={0: "TRG"}, errors="raise", inplace=True)
 train_df = pd.concat([df1, df2], axis=1)
 
-train_df["src_len"] = ""
-train_df["trg_len"] = ""
+# 공백 기준 단어 수를 한 번에(벡터 연산으로) 계산한다.
+train_df["src_len"] = word_lengths(train_df['SRC'])
+train_df["trg_len"] = word_lengths(train_df['TRG'])
 train_df.head()
 
-for idx in range(len(train_df['SRC'])):
-    # initialize string
-    text_eng = str(train_df.iloc[idx]['SRC'])
-
-    # default separator: space
-    result_eng = len(text_eng.split())
-    train_df.at[idx, 'src_len'] = int(result_eng)
-
-    text_fra = str(train_df.iloc[idx]['TRG'])
-    # default separator: space
-    result_fra = len(text_fra.split())
-    train_df.at[idx, 'trg_len'] = int(result_fra)
-
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["SRC"])
-print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
-
-train_df = train_df.drop_duplicates(subset = ["TRG"])
+# 중복된 질문, 답변은 load_preprocessed_data() 에서 이미 제거되었다.
 print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
 
 # 그 결과를 새로운 변수에 할당합니다.
-is_within_len = (4 < train_df['src_len']) & (train_df['src_len'] <= 20) & (4 < train_df['trg_len']) & (train_df['trg_len'] <=20)
+is_within_len = within_len(train_df, 4, 20)
 # 조건를 충족하는 데이터를 필터링하여 새로운 변수에 저장합니다.
 train_df = train_df[is_within_len]
 
-dataset_df_8096 = train_df.sample(n=1024*8, # number of items from axis to return.
-          random_state=1234) # seed for random number generator for reproducibility
+if NEAR_DUP_THRESHOLD is not None and SAMPLE_MODE != 'reservoir':
+    # 거의 같은 질문, 답변을 제거한다. (reservoir 는 load_preprocessed_data() 에서 이미 제거)
+    train_df = near_dedup(train_df, threshold=NEAR_DUP_THRESHOLD)
+    print('Translation Pair :',len(train_df)) # 리뷰 개수 출력
+
+dataset_df_8096 = sample_pairs(train_df, N_SAMPLES, # number of items from axis to return.
+          mode=SAMPLE_MODE, seed=1234) # seed for random number generator for reproducibility
 
 print('Translation Pair :',len(dataset_df_8096)) # 리뷰 개수 출력
 
 raw_src = dataset_df_8096['SRC']
 raw_trg = dataset_df_8096['TRG']
 
-special_tkns = "<PAD> <SOS> <EOS> <CLS> <SEP> <MASK> "
-src_sentence  = raw_src.apply(lambda x: "<CLS> " + str(x) + " <SEP>")
-trg_sentence  = raw_trg.apply(lambda x: str(x) + " <SEP>")
-
-filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
-oov_token = '<unk>'
-
-# Define tokenizer
-SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token)
-
-SRC_tokenizer.fit_on_texts(special_tkns + src_sentence)
-TRG_tokenizer.fit_on_texts(special_tkns + trg_sentence)
-
-n_enc_vocab = len(SRC_tokenizer.word_index) + 7
-n_dec_vocab = len(TRG_tokenizer.word_index) + 6
+if USE_BYTE_BPE:
+    # 질문과 답변을 합쳐 GPT-2 와 같은 byte-level BPE 단어 집합 하나를 만든다. (<unk> 없음)
+    # 특수 토큰이 0 ~ 2 번이므로 <PAD> 는 패딩 번호 0 과 같다. 같은 코퍼스로 만든 merge 목록은 캐시에서 읽어온다.
+    SRC_tokenizer = TRG_tokenizer = build_byte_bpe(
+        raw_src.tolist() + raw_trg.tolist(), vocab_size=BPE_VOCAB_SIZE,
+        special_tokens=[PAD, CLS, SEP])
+    # 추론할 때는 byte_bpe.ByteBPETokenizer.load(os.path.join(TOKENIZER_DIR, 'bpe_tokenizer.json')) 로 읽어온다.
+    TOKENIZER_DIR = "./checkpoints"
+    SRC_tokenizer.save(os.path.join(TOKENIZER_DIR, 'bpe_tokenizer.json'))
+else:
+    filters = '!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n'
+    oov_token = '<unk>'
+
+    # Define tokenizer
+    SRC_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
+    TRG_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters = filters, oov_token=oov_token, num_words=MAX_VOCAB_SIZE)
+
+    SRC_tokenizer.fit_on_texts(raw_src)
+    TRG_tokenizer.fit_on_texts(raw_trg)
+
+    if MAX_VOCAB_SIZE:
+        # 상위 단어만 남겼을 때 학습 데이터에서 <unk> 로 바뀌는 토큰의 비율
+        for name, fitted in (('SRC', SRC_tokenizer), ('TRG', TRG_tokenizer)):
+            coverage = vocab_coverage(fitted)
+            print('{} coverage : {:.2%}, OOV : {:.2%}'.format(
+                name, coverage['token_coverage'], coverage['oov_rate']))
+
+    # 학습에 쓴 tokenizer 는 단어 집합과 설정만 남긴 읽기 전용 tokenizer 로 바꾸어 체크포인트 폴더에 저장한다.
+    # 추론할 때는 tokenizer_utils.load_tokenizer(os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json')) 로 코퍼스 없이 바로 읽어온다.
+    TOKENIZER_DIR = "./checkpoints"
+    SRC_tokenizer = save_tokenizer(SRC_tokenizer, os.path.join(TOKENIZER_DIR, 'SRC_tokenizer.json'))
+    TRG_tokenizer = save_tokenizer(TRG_tokenizer, os.path.join(TOKENIZER_DIR, 'TRG_tokenizer.json'))
+
+# 특수 토큰은 단어로 학습시키지 않고 단어 집합 바로 뒤 번호를 준다. (패딩은 0 번)
+# 답변에는 SEP 토큰만 쓰이므로 TRG 단어 집합에는 SEP 만 더한다. (byte-level BPE 는 이미 들어 있는 번호를 그대로 쓴다)
+SRC_tokenizer = SpecialTokenizer(SRC_tokenizer, [PAD, CLS, SEP])
+TRG_tokenizer = SRC_tokenizer if USE_BYTE_BPE else SpecialTokenizer(TRG_tokenizer, [PAD, SEP])
+
+CLS_SRC, SEP_SRC = [SRC_tokenizer.token_id(CLS)], [SRC_tokenizer.token_id(SEP)]
+
+SEP_TRG = [TRG_tokenizer.token_id(SEP)]
+
+# 특수 토큰까지 포함한 정확한 단어 집합의 크기
+n_enc_vocab = SRC_tokenizer.vocab_size
+n_dec_vocab = TRG_tokenizer.vocab_size
 
 print('Encoder 단어 집합의 크기 :',n_enc_vocab)
 print('Decoder 단어 집합의 크기 :',n_dec_vocab)
@@ -186,25 +227,36 @@ for line in lines:
 
 
 # 토큰화 / 정수 인코딩 / 시작 토큰과 종료 토큰 추가 / 패딩
-tokenized_inputs  = SRC_tokenizer.texts_to_sequences(src_sentence)
-tokenized_outputs = TRG_tokenizer.texts_to_sequences(trg_sentence)
-
-pad_idx = SRC_tokenizer.texts_to_sequences(['<PAD>'])
-
-tkn_sources  = []
-tkn_targets  = []
-
-for idx in range(len(tokenized_inputs)):
-    indexed_src_tkns = tokenized_inputs[idx] + [0] * (ENCODER_LEN - len(tokenized_inputs[idx]))
-    indexed_trg_tkns = [0]*len(tokenized_inputs[idx]) + tokenized_outputs[idx] + [0]*(ENCODER_LEN - len(tokenized_inputs[idx])-len(tokenized_outputs[idx]))
-
-    tkn_sources.append(indexed_src_tkns)
-    tkn_targets.append(indexed_trg_tkns)
-    
-tensors_src = tf.cast(tkn_sources, dtype=tf.int64)
-tensors_trg = tf.cast(tkn_targets, dtype=tf.int64)
-# tensors_seg = tf.cast(tkn_segments, dtype=tf.int64)
-
+# 문장 목록 전체를 한 번에 정수 인코딩한다. (texts_to_sequences 와 같은 번호의 RaggedTensor)
+SRC_encoder = batch_tokenizer(SRC_tokenizer)
+TRG_encoder = batch_tokenizer(TRG_tokenizer)
+
+tokenized_inputs  = SRC_encoder(raw_src, prefix=CLS_SRC, suffix=SEP_SRC)
+tokenized_outputs = TRG_encoder(raw_trg, suffix=SEP_TRG)
+
+# 질문 뒤에 답변이 오도록 source / target 을 한 번에 만든다.
+# 질문과 답변을 합친 길이가 ENCODER_LEN 을 넘는 쌍은 뺀다. (overflow='truncate' 이면 답변의 마지막 토큰은 남기고 잘라서 넣는다)
+tensors_src, tensors_trg, _, is_packed = pack_pairs(
+    tokenized_inputs, tokenized_outputs, ENCODER_LEN, overflow='drop')
+
+if PACK_SEQUENCES:
+    # 쌍의 길이(질문 + 답변)는 target 행의 마지막 토큰 위치로 알 수 있다.
+    n_pairs = len(tensors_src)
+    (tensors_src, tensors_trg), example_ids, positions = pack_sequences(
+        [tensors_src, tensors_trg], content_length(tensors_trg), pad_ids=[0, 0])
+    print('{} 개의 쌍을 {} 개의 행으로 묶었다.'.format(n_pairs, len(tensors_src)))
+
+# 데이터셋 캐시와 디바이스 전송에는 id 를 int64 대신 int16 / int32 로 저장한다.
+# (train_step 에서 디바이스로 옮겨진 뒤 int64 로 바꾼다)
+tensors_src, tensors_trg = compact_ids(
+    tensors_src, tensors_trg, vocab_size=max(n_enc_vocab, n_dec_vocab))
+if PACK_SEQUENCES:
+    # 토큰 샤드는 모든 feature 를 한 dtype 으로 저장하므로 토큰 id 와 같은 dtype 을 쓴다.
+    example_ids, positions = compact_ids(example_ids, positions, vocab_size=ENCODER_LEN + 1,
+                                         dtype=tensors_src.dtype)
+print('토큰 저장 dtype :', tensors_src.dtype.name, '(int64 의 1/{})'.format(8 // tensors_src.dtype.size))
+
+print('길이를 넘어 제외된 쌍     :', int(tf.reduce_sum(tf.cast(~is_packed, tf.int32))))
 print('질문 데이터의 크기(shape) :', tensors_src.shape)
 print('답변 데이터의 크기(shape) :', tensors_trg.shape)
 
@@ -218,13 +270,33 @@ pf_dim    = 1024
 n_heads   = 8
 dropout   = 0.3
 
-dataset = tf.data.Dataset.from_tensor_slices((tensors_src, tensors_trg))
+features = {'inputs': tensors_src, 'targets': tensors_trg}
+if PACK_SEQUENCES:
+    features.update(example_ids=example_ids, positions=positions)
+
+if USE_TOKEN_SHARDS:
+    # 같은 데이터는 한 번만 내보낸다. (캐시 폴더의 shards/<해시> 아래)
+    shard_dir = export_token_shards(features)
+    print('토큰 샤드 :', shard_dir)
+    dataset = read_token_shards(shard_dir)
+else:
+    dataset = tf.data.Dataset.from_tensor_slices(tuple(features.values()))
+    dataset = dataset.cache()
 
-dataset = dataset.cache()
 dataset = dataset.shuffle(BUFFER_SIZE)
-dataset = dataset.batch(BATCH_SIZE)
+if BATCH_MODE == 'bucket':
+    # 배치의 패딩은 가장 긴 문장 길이(8 의 배수)까지만 남긴다.
+    dataset = bucket_by_length(dataset, BATCH_SIZE, trim_by=(1,) * len(dataset.element_spec),
+                               token_budget=TOKEN_BUDGET)
+else:
+    dataset = dataset.batch(BATCH_SIZE)
 dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
+# 패딩이 차지하는 비율
+if PADDING_REPORT_BATCHES:
+    print_padding_report(BATCH_MODE, padding_report(dataset, components=(1,),
+                                                    max_batches=PADDING_REPORT_BATCHES))
+
 """ sinusoid position encoding """
 def get_sinusoid_encoding_table(position, hid_dim):
     # angle_rads = get_angles(np.arange(position)[:, np.newaxis],
@@ -261,6 +333,13 @@ def create_look_ahead_mask(size):
     mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
     return mask
 
+""" attention mask of packed rows """
+def create_block_mask(example_ids):
+    # 서로 다른 쌍(example_ids 가 다른 위치)끼리는 어텐션하지 않는다.
+    mask = tf.math.not_equal(example_ids[:, :, tf.newaxis], example_ids[:, tf.newaxis, :])
+    # (batch_size, 1, query의 문장 길이, key의 문장 길이)
+    return tf.cast(mask, tf.float32)[:, tf.newaxis, :, :]
+
 """ scale dot product attention """
 def ScaledDotProductAttention(query, key, value, mask):
     """Calculate the attention weights.
@@ -434,14 +513,18 @@ class Decoder(tf.keras.layers.Layer):
                            for _ in range(n_layers)]
         self.dropout = tf.keras.layers.Dropout(dropout)
 
-    def call(self, dec_input, training, look_ahead_mask):
+    def call(self, dec_input, training, look_ahead_mask, positions=None):
 
         seq_len = tf.shape(dec_input)[1]
         attention_weights = {}
 
         emb = self.embedding(dec_input)
         emb *= tf.math.sqrt(tf.cast(self.hid_dim, tf.float32))
-        emb += self.pos_encoding[:, :seq_len, :]
+        if positions is None:
+            emb += self.pos_encoding[:, :seq_len, :]
+        else:
+            # 여러 쌍을 묶은 행은 쌍마다 위치 번호가 0 부터 다시 시작한다.
+            emb += tf.gather(self.pos_encoding[0], positions)
 
         output = self.dropout(emb, training=training)
 
@@ -452,11 +535,14 @@ class Decoder(tf.keras.layers.Layer):
     
         return output, attention_weights
     
-def create_masks(tar):
+def create_masks(tar, example_ids=None):
 
     look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
     dec_target_padding_mask = create_padding_mask(tar)
     look_ahead_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+    if example_ids is not None:
+        # 여러 쌍을 묶은 행 : causal 마스크를 쌍마다 나눈 block-diagonal 마스크
+        look_ahead_mask = tf.maximum(look_ahead_mask, create_block_mask(example_ids))
   
     return look_ahead_mask
 
@@ -469,15 +555,16 @@ class GPT2(tf.keras.Model):
                  pe_input, pe_target, dropout):
         super(GPT2, self).__init__()
 
-        self.decoder = Decoder(n_dec_vocab,
+        # 입력 시퀀스는 질문(SRC) 번호이므로 임베딩은 SRC 단어 집합 크기로 만든다.
+        self.decoder = Decoder(n_enc_vocab,
                                n_layers, pf_dim, hid_dim, n_heads,
                                pe_target, dropout)
 
         self.fin_output = tf.keras.layers.Dense(n_dec_vocab)
     
-    def call(self, inp, training, look_ahead_mask):
+    def call(self, inp, training, look_ahead_mask, positions=None):
 
-        dec_output, attention_weights = self.decoder(inp, training, look_ahead_mask)
+        dec_output, attention_weights = self.decoder(inp, training, look_ahead_mask, positions)
 
         final_output = self.fin_output(dec_output)
 
@@ -557,13 +644,18 @@ if ckpt_manager.latest_checkpoint:
     ckpt.restore(ckpt_manager.latest_checkpoint)
     print('Latest checkpoint restored!!')
 
-@tf.function
-def train_step(inp, tar):
+@tf.function(reduce_retracing=True)
+def train_step(inp, tar, example_ids=None, positions=None):
+    # 데이터셋의 int16 / int32 id 를 디바이스에서 int64 로 바꾼다.
+    inp = tf.cast(inp, tf.int64)
+    tar = tf.cast(tar, tf.int64)
 
-    combined_mask = create_masks(inp)
+    combined_mask = create_masks(inp, example_ids)
+    if positions is not None:
+        positions = tf.cast(positions, tf.int64)
 
     with tf.GradientTape() as tape:
-        predictions, _ = model(inp, True, combined_mask)
+        predictions, _ = model(inp, True, combined_mask, positions)
         loss = loss_function(tar, predictions)
 
     gradients = tape.gradient(loss, model.trainable_variables)
@@ -572,23 +664,32 @@ def train_step(inp, tar):
     train_loss(loss)
     train_accuracy(accuracy_function(tar, predictions))
 
+# 패딩을 뺀 실제 토큰 수로 초당 처리량을 잰다.
+token_rate = TokenRate()
+
 for epoch in range(N_EPOCHS):
     train_loss.reset_states()
+    token_rate.reset()
     
-    with tqdm_notebook(total=len(dataset), desc=f"Train {epoch+1}") as pbar:
-        for (batch, (inp, tar)) in enumerate(dataset):
-            train_step(inp, tar)
+    # bucket 모드에서는 배치 수를 미리 알 수 없다. (None)
+    with tqdm_notebook(total=num_batches(dataset), desc=f"Train {epoch+1}") as pbar:
+        for (batch, (inp, tar, *packing)) in enumerate(dataset):
+            train_step(inp, tar, *packing)
+            token_rate.update(tar)
     
             pbar.update(1)
             pbar.set_postfix_str(f"Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}")
             
     # print(f'Epoch {epoch + 1} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
+    print(f'Epoch {epoch + 1} : {token_rate.result():.0f} tokens/sec')
     
 ckpt_save_path = ckpt_manager.save()
 print ('Saving checkpoint for epoch {} at {}'.format(epoch+1, ckpt_save_path))
 
 """
 def evaluate(text):
+    # 학습 데이터와 같은 정규화를 거친다.
+    text = preprocess_eng(text)
     text = SRC_tokenizer.texts_to_sequences([text])
     text = tf.keras.preprocessing.sequence.pad_sequences(text, maxlen=ENCODER_LEN,
                                                          padding='post', truncating='post')
@@ -0,0 +1,314 @@
+"""
+Byte-level BPE tokenizer, as used by GPT-2, in pure Python.
+
+Text is split into words with the GPT-2 pre-tokenizer regex, every word is
+written as its UTF-8 bytes (each byte shown as a printable character, the
+``bytes_to_unicode`` table of GPT-2) and the most frequent adjacent pair of
+symbols is merged until the vocabulary reaches ``vocab_size``:
+
+    ids 0 .. k-1          the special tokens, in the order given
+    ids k .. k+255        the 256 single bytes
+    ids k+256 ..          one per merge, in merge order
+
+Any string can be encoded, so there is no OOV token. ``train_byte_bpe``
+keeps the pair counts and a max-heap of them up to date incrementally, so a
+merge only touches the words containing that pair. ``ByteBPETokenizer``
+encodes a word by repeatedly merging its lowest-ranked pair, with the ids of
+every word kept in a bounded LRU cache; ``batch_tokenizer`` encodes whole
+sentence lists with it. Special tokens written in the text (``"<CLS> hi
+<SEP>"``) are matched first and take the surrounding spaces with them.
+
+``build_byte_bpe`` caches the trained merges next to the subword
+vocabularies. Run ``python byte_bpe.py`` to compare sequence lengths, OOV
+rate and encoding speed with the word and subword tokenizers.
+"""
+import os
+import re
+import json
+import heapq
+import itertools
+import functools
+import collections
+
+from cornell_corpus import default_cache_dir, corpus_key
+
+BYTE_BPE_VERSION = 1
+
+# GPT-2 pre-tokenizer; \p{L} / \p{N} written with the classes of ``re``.
+_PRETOKENIZE_RE = re.compile(
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+
+@functools.lru_cache(maxsize=None)
+def bytes_to_unicode():
+    """ byte -> printable character table of GPT-2 (printable bytes map to themselves) """
+    bs = (list(range(ord('!'), ord('~') + 1)) + list(range(ord('\xa1'), ord('\xac') + 1))
+          + list(range(ord('\xae'), ord('\xff') + 1)))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+def _byte_words(text):
+    """ pre-tokenized words of ``text``, each as its byte characters """
+    byte_encoder = bytes_to_unicode()
+    return [''.join(byte_encoder[b] for b in word.encode('utf-8'))
+            for word in _PRETOKENIZE_RE.findall(text)]
+
+
+def _pair_counts(symbols):
+    return collections.Counter(zip(symbols[:-1], symbols[1:]))
+
+
+def _merge_symbols(symbols, pair, merged):
+    out = []
+    i, n = 0, len(symbols)
+    while i < n:
+        if i < n - 1 and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            out.append(merged)
+            i += 2
+        else:
+            out.append(symbols[i])
+            i += 1
+    return out
+
+
+def train_byte_bpe(corpus, vocab_size=2**13, special_tokens=(), min_frequency=2):
+    """Learn the merges of a byte-level BPE vocabulary of ``vocab_size`` ids.
+
+    Stops early when no pair occurs ``min_frequency`` times. Ties are broken
+    by the pair itself, so the same corpus always gives the same merges.
+    """
+    word_counts = collections.Counter()
+    for line in corpus:
+        word_counts.update(_byte_words(line))
+    words = [list(word) for word in word_counts]
+    freqs = list(word_counts.values())
+
+    pair_counts = collections.defaultdict(int)
+    where = collections.defaultdict(set)
+    for idx, symbols in enumerate(words):
+        for pair, count in _pair_counts(symbols).items():
+            pair_counts[pair] += count * freqs[idx]
+            where[pair].add(idx)
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    n_merges = vocab_size - len(special_tokens) - 256
+    while heap and len(merges) < n_merges:
+        count, pair = heapq.heappop(heap)
+        count = -count
+        current = pair_counts.get(pair, 0)
+        if count != current:
+            # stale entry: the pair lost occurrences since it was pushed
+            if current > 0:
+                heapq.heappush(heap, (-current, pair))
+            continue
+        if count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+
+        changed = set()
+        for idx in where.pop(pair):
+            symbols = words[idx]
+            new_symbols = _merge_symbols(symbols, pair, merged)
+            old_pairs = _pair_counts(symbols)
+            new_pairs = _pair_counts(new_symbols)
+            words[idx] = new_symbols
+            for p, c in old_pairs.items():
+                pair_counts[p] -= c * freqs[idx]
+                if p not in new_pairs:
+                    where[p].discard(idx)
+            for p, c in new_pairs.items():
+                pair_counts[p] += c * freqs[idx]
+                where[p].add(idx)
+                changed.add(p)
+        pair_counts.pop(pair, None)
+        # pairs that gained occurrences need a fresh heap entry
+        for p in changed:
+            if p != pair and pair_counts[p] > 0:
+                heapq.heappush(heap, (-pair_counts[p], p))
+    return merges
+
+
+class ByteBPETokenizer(object):
+    """Byte-level BPE encoder / decoder over a list of merges.
+
+    ``encode`` / ``decode`` / ``vocab_size`` follow ``SubwordTextEncoder``
+    and ``texts_to_sequences`` / ``sequences_to_texts`` follow the Keras
+    ``Tokenizer``, so it can stand in for either in the scripts.
+    """
+
+    def __init__(self, merges, special_tokens=(), cache_size=1 << 18):
+        self.merges = [tuple(pair) for pair in merges]
+        self.special_tokens = list(special_tokens)
+        byte_encoder = self._byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {c: b for b, c in byte_encoder.items()}
+
+        self.tokens = (self.special_tokens + [byte_encoder[b] for b in range(256)]
+                       + [a + b for a, b in self.merges])
+        # special tokens are looked up on their own: a merge may spell the same text
+        self.special_index = {token: idx for idx, token in enumerate(self.special_tokens)}
+        self.token_index = {}
+        for idx in range(len(self.special_tokens), len(self.tokens)):
+            self.token_index.setdefault(self.tokens[idx], idx)
+        self.bpe_ranks = {pair: rank for rank, pair in enumerate(self.merges)}
+        self._n_special = len(self.special_tokens)
+        if self.special_tokens:
+            self._special_re = re.compile(r'\s*({})\s*'.format('|'.join(
+                map(re.escape, sorted(self.special_tokens, key=len, reverse=True)))))
+        else:
+            self._special_re = None
+        self._word_ids = functools.lru_cache(maxsize=cache_size)(self._word_to_ids)
+
+    @property
+    def vocab_size(self):
+        return len(self.tokens)
+
+    def token_to_id(self, token):
+        if token in self.special_index:
+            return self.special_index[token]
+        return self.token_index[token]
+
+    def _bpe(self, word):
+        symbols = list(word)
+        bpe_ranks = self.bpe_ranks
+        while len(symbols) > 1:
+            ranks = [bpe_ranks.get(pair) for pair in zip(symbols[:-1], symbols[1:])]
+            best = min((rank for rank in ranks if rank is not None), default=None)
+            if best is None:
+                break
+            pair = self.merges[best]
+            symbols = _merge_symbols(symbols, pair, pair[0] + pair[1])
+        return symbols
+
+    def _word_to_ids(self, word):
+        byte_encoder, token_index = self._byte_encoder, self.token_index
+        symbols = self._bpe(''.join(byte_encoder[b] for b in word.encode('utf-8')))
+        return tuple(token_index[symbol] for symbol in symbols)
+
+    def _encode_text(self, text):
+        return itertools.chain.from_iterable(map(self._word_ids, _PRETOKENIZE_RE.findall(text)))
+
+    def encode(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        if self._special_re is None:
+            return list(self._encode_text(text))
+        ids = []
+        # re.split keeps the special tokens at the odd positions
+        for i, piece in enumerate(self._special_re.split(text)):
+            if i % 2:
+                ids.append(self.special_index[piece])
+            elif piece:
+                ids.extend(self._encode_text(piece))
+        return ids
+
+    def decode(self, ids, skip_special_tokens=True):
+        byte_decoder = self.byte_decoder
+        data = bytearray()
+        for idx in ids:
+            idx = int(idx)
+            if idx < self._n_special:
+                if not skip_special_tokens:
+                    data += self.tokens[idx].encode('utf-8')
+            elif idx < len(self.tokens):
+                data.extend(byte_decoder[c] for c in self.tokens[idx])
+        return data.decode('utf-8', errors='replace')
+
+    def texts_to_sequences(self, texts):
+        return [self.encode(text) for text in texts]
+
+    def sequences_to_texts(self, sequences):
+        return [self.decode(seq) for seq in sequences]
+
+    def save(self, path):
+        data = {'version': BYTE_BPE_VERSION, 'special_tokens': self.special_tokens,
+                'merges': [list(pair) for pair in self.merges]}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return self
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != BYTE_BPE_VERSION:
+            raise ValueError('{}: unsupported byte BPE version {}'.format(path, data.get('version')))
+        return cls(data['merges'], data['special_tokens'])
+
+
+def build_byte_bpe(corpus, vocab_size=2**13, special_tokens=(), min_frequency=2, cache_dir=None):
+    """``train_byte_bpe`` cached by a hash of the corpus and the arguments."""
+    corpus = list(corpus)
+    special_tokens = list(special_tokens)
+    cache_dir = os.path.join(cache_dir or default_cache_dir(), 'vocab')
+    key = corpus_key(corpus, 'byte_bpe', BYTE_BPE_VERSION, vocab_size, special_tokens, min_frequency)
+    path = os.path.join(cache_dir, key + '.bpe.json')
+
+    if os.path.exists(path):
+        return ByteBPETokenizer.load(path)
+    merges = train_byte_bpe(corpus, vocab_size, special_tokens, min_frequency)
+    return ByteBPETokenizer(merges, special_tokens).save(path)
+
+
+def encoding_stats(encoder, sentences, oov_id=None):
+    """ tokens/sec, sentences/sec, mean / max length and OOV rate of one batched encode """
+    import time
+
+    start = time.perf_counter()
+    ids = encoder(sentences)
+    elapsed = time.perf_counter() - start
+    lengths = ids.row_lengths().numpy()
+    n_tokens = int(lengths.sum())
+    n_oov = int((ids.flat_values.numpy() == oov_id).sum()) if oov_id is not None else 0
+    return {'tokens_per_sec': n_tokens / elapsed,
+            'sentences_per_sec': len(sentences) / elapsed,
+            'mean_len': n_tokens / max(len(sentences), 1),
+            'max_len': int(lengths.max()) if len(lengths) else 0,
+            'oov_rate': n_oov / n_tokens if n_tokens else 0.0}
+
+
+if __name__ == '__main__':
+    import tensorflow as tf
+
+    from cornell_corpus import fetch_corpus
+    from corpus_store import open_corpus_store
+    from text_preprocessing import cached_preprocess
+    from tokenizer_utils import batch_tokenizer, build_subword_tokenizer
+
+    normalize = cached_preprocess()
+    store = open_corpus_store(fetch_corpus())
+    sentences = [normalize(trg) for _, trg in store.iter_pairs()]
+    print('Sentences :', len(sentences))
+
+    keras_tokenizer = tf.keras.preprocessing.text.Tokenizer(
+        filters='!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n', oov_token='<unk>')
+    keras_tokenizer.fit_on_texts(sentences)
+    tokenizers = [
+        ('keras word', keras_tokenizer, keras_tokenizer.word_index['<unk>'],
+         len(keras_tokenizer.word_index) + 1),
+    ]
+    subword = build_subword_tokenizer(sentences, target_vocab_size=2**13)
+    tokenizers.append(('subword', subword, None, subword.vocab_size))
+    bpe = build_byte_bpe(sentences, vocab_size=2**13)
+    tokenizers.append(('byte BPE', bpe, None, bpe.vocab_size))
+
+    print('{:<11} {:>7} {:>9} {:>8} {:>7} {:>13}'.format(
+        'tokenizer', 'vocab', 'mean len', 'max len', 'OOV', 'tokens/sec'))
+    for name, tokenizer, oov_id, vocab_size in tokenizers:
+        row = encoding_stats(batch_tokenizer(tokenizer), sentences, oov_id)
+        print('{:<11} {:>7} {:>9.2f} {:>8} {:>6.2%} {:>13,.0f}'.format(
+            name, vocab_size, row['mean_len'], row['max_len'], row['oov_rate'],
+            row['tokens_per_sec']))
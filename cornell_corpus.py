@@ -0,0 +1,403 @@
+"""
+Cornell Movie-Dialogs corpus acquisition shared by the chatbot scripts.
+
+The archive is downloaded once into a local content-addressed cache and
+verified against a checksum manifest on every later run, so repeated
+training / evaluation runs skip the network and the unzip entirely.
+
+Environment variables
+    CHATBOT_CACHE_DIR   : cache directory (default ~/.cache/chatbot_corpus)
+    CHATBOT_OFFLINE     : "1" to never touch the network
+    CHATBOT_MIRROR_DIR  : local directory holding pre-downloaded archives
+"""
+import io
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import zipfile
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+CORNELL_URL = 'http://www.cs.cornell.edu/~cristian/data/cornell_movie_dialogs_corpus.zip'
+CORNELL_FILENAME = 'cornell_movie_dialogs_corpus.zip'
+
+MANIFEST_NAME = 'manifest.json'
+EXTRACT_MARKER = '.corpus_sha256'
+CHUNK_SIZE = 1 << 20
+
+
+def default_cache_dir():
+    return os.environ.get('CHATBOT_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'chatbot_corpus'))
+
+
+def file_sha256(path):
+    """ sha256 of a file, read in 1MB chunks """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def corpus_key(corpus, *args):
+    """ sha256 of the corpus lines and any extra build arguments (cache key of derived files) """
+    digest = hashlib.sha256(repr(args).encode('utf-8'))
+    for line in corpus:
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _blob_path(cache_dir, sha256):
+    return os.path.join(cache_dir, 'blobs', sha256)
+
+
+def _verify(path, sha256, size=None, verify=True):
+    if not os.path.exists(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if not verify:
+        return True
+    return file_sha256(path) == sha256
+
+
+def _add_to_cache(cache_dir, manifest, url, filename, src_path, sha256=None):
+    """Move a downloaded / mirrored file into the blob store and record it."""
+    actual = file_sha256(src_path)
+    if sha256 is not None and actual != sha256:
+        raise ValueError('Checksum mismatch for {}: expected {}, got {}'.format(
+            filename, sha256, actual))
+
+    blob = _blob_path(cache_dir, actual)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if os.path.abspath(src_path) != os.path.abspath(blob):
+        shutil.copyfile(src_path, blob + '.tmp')
+        os.replace(blob + '.tmp', blob)
+
+    manifest[url] = {'filename': filename,
+                     'sha256': actual,
+                     'size': os.path.getsize(blob)}
+    save_manifest(cache_dir, manifest)
+    return blob
+
+
+def _download(url, dest_path):
+    """Download ``url`` to ``dest_path``, resuming from ``dest_path + '.part'``."""
+    import urllib3
+
+    part_path = dest_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    http = urllib3.PoolManager()
+    with http.request('GET', url, headers=headers, preload_content=False) as r:
+        if r.status == 416:
+            # the partial file is already complete
+            pass
+        elif r.status == 206 and offset:
+            with open(part_path, 'ab') as out_file:
+                shutil.copyfileobj(r, out_file, CHUNK_SIZE)
+        elif r.status == 200:
+            # server ignored the Range header, start over
+            with open(part_path, 'wb') as out_file:
+                shutil.copyfileobj(r, out_file, CHUNK_SIZE)
+        else:
+            raise IOError('Download of {} failed with HTTP {}'.format(url, r.status))
+
+    os.replace(part_path, dest_path)
+    return dest_path
+
+
+def fetch_corpus(url=CORNELL_URL, filename=CORNELL_FILENAME, sha256=None,
+                 cache_dir=None, mirror_dir=None, offline=None, verify=True):
+    """Return a local path to the corpus archive, downloading it at most once.
+
+    Lookup order: cache (checked against the manifest), ``mirror_dir``,
+    network. ``sha256`` pins the expected checksum; otherwise the checksum of
+    the first successful fetch is recorded in the manifest and enforced
+    afterwards. ``verify=False`` only checks the file size, which is enough
+    for multi-gigabyte dumps on a trusted disk.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    mirror_dir = mirror_dir or os.environ.get('CHATBOT_MIRROR_DIR')
+    if offline is None:
+        offline = os.environ.get('CHATBOT_OFFLINE', '0') == '1'
+    os.makedirs(cache_dir, exist_ok=True)
+
+    manifest = load_manifest(cache_dir)
+    entry = manifest.get(url)
+    if entry is not None and (sha256 is None or entry['sha256'] == sha256):
+        blob = _blob_path(cache_dir, entry['sha256'])
+        if _verify(blob, entry['sha256'], entry['size'], verify):
+            return blob
+    expected = sha256 or (entry or {}).get('sha256')
+
+    if mirror_dir is not None:
+        mirrored = os.path.join(mirror_dir, filename)
+        if os.path.exists(mirrored):
+            return _add_to_cache(cache_dir, manifest, url, filename, mirrored, expected)
+
+    if offline:
+        raise FileNotFoundError(
+            '{} is not cached in {} and offline mode is enabled'.format(filename, cache_dir))
+
+    download_path = os.path.join(cache_dir, 'downloads', filename)
+    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+    _download(url, download_path)
+    try:
+        blob = _add_to_cache(cache_dir, manifest, url, filename, download_path, expected)
+    finally:
+        if os.path.exists(download_path):
+            os.remove(download_path)
+    return blob
+
+
+def archive_sha256(zip_path):
+    """ checksum of an archive; blobs are named after theirs, so no need to hash them again """
+    if os.path.basename(os.path.dirname(zip_path)) == 'blobs':
+        return os.path.basename(zip_path)
+    return file_sha256(zip_path)
+
+
+def _corpus_root(names, member='movie_lines.txt'):
+    for name in names:
+        if name.startswith('__MACOSX'):
+            continue
+        if os.path.basename(name) == member:
+            return os.path.dirname(name)
+    raise FileNotFoundError('{} not found in archive'.format(member))
+
+
+def extract_corpus(zip_path, path):
+    """Extract the archive under ``path`` unless an identical copy is already there.
+
+    Returns the directory that contains ``movie_lines.txt``.
+    """
+    sha256 = archive_sha256(zip_path)
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        corpus_dir = os.path.join(path, _corpus_root(zip_ref.namelist()))
+        marker = os.path.join(corpus_dir, EXTRACT_MARKER)
+        if os.path.exists(marker):
+            with open(marker) as f:
+                if f.read().strip() == sha256:
+                    return corpus_dir
+        zip_ref.extractall(path)
+
+    with open(marker, 'w') as f:
+        f.write(sha256)
+    return corpus_dir
+
+
+# ---------------------------------------------------------------------------
+# Streaming readers
+# ---------------------------------------------------------------------------
+FIELD_SEP = ' +++$+++ '
+MOVIE_LINES = 'movie_lines.txt'
+MOVIE_CONVERSATIONS = 'movie_conversations.txt'
+
+
+def _iter_zip_lines(zip_path, member, errors):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        root = _corpus_root(zip_ref.namelist(), member)
+        name = root + '/' + member if root else member
+        with zip_ref.open(name) as raw:
+            with io.TextIOWrapper(raw, encoding='utf-8', errors=errors) as file:
+                for line in file:
+                    yield line
+
+
+def _iter_mmap_lines(path, errors):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b''):
+                yield line.decode('utf-8', errors).replace('\r\n', '\n')
+
+
+def _iter_file_lines(path, errors):
+    with open(path, encoding='utf-8', errors=errors) as file:
+        for line in file:
+            yield line
+
+
+def iter_corpus_lines(source, member, errors='ignore', use_mmap=False):
+    """Yield the lines of ``member`` one at a time.
+
+    ``source`` is either the corpus zip, read member-by-member without
+    extracting anything to disk, or a directory holding an extracted copy,
+    which is read through an mmap when ``use_mmap`` is set.
+    """
+    if zipfile.is_zipfile(source):
+        return _iter_zip_lines(source, member, errors)
+    path = os.path.join(source, member)
+    if use_mmap:
+        return _iter_mmap_lines(path, errors)
+    return _iter_file_lines(path, errors)
+
+
+def parse_movie_line(line):
+    """ 'L1045 +++$+++ u0 +++$+++ m0 +++$+++ BIANCA +++$+++ text' -> (line id, text) """
+    parts = line.replace('\n', '').split(FIELD_SEP)
+    return parts[0], parts[4]
+
+
+def parse_conversation(line):
+    """ "u0 +++$+++ u2 +++$+++ m0 +++$+++ ['L194', 'L195']" -> ['L194', 'L195'] """
+    parts = line.replace('\n', '').split(FIELD_SEP)
+    return [line_id[1:-1] for line_id in parts[3][1:-1].split(', ')]
+
+
+def load_id2line(source, use_mmap=False):
+    """ dictionary of line id to text """
+    id2line = {}
+    for line in iter_corpus_lines(source, MOVIE_LINES, errors='ignore', use_mmap=use_mmap):
+        line_id, text = parse_movie_line(line)
+        id2line[line_id] = text
+    return id2line
+
+
+def iter_conversations(source, use_mmap=False):
+    """ yield every conversation as a list of line ids """
+    for line in iter_corpus_lines(source, MOVIE_CONVERSATIONS, errors='strict', use_mmap=use_mmap):
+        yield parse_conversation(line)
+
+
+def iter_dialog_pairs(source, use_mmap=False):
+    """Yield raw (question, answer) text for every adjacent utterance pair.
+
+    Only the line table is held in memory; conversations are streamed.
+    """
+    id2line = load_id2line(source, use_mmap)
+    for conversation in iter_conversations(source, use_mmap):
+        for i in range(len(conversation) - 1):
+            yield id2line[conversation[i]], id2line[conversation[i + 1]]
+
+
+# ---------------------------------------------------------------------------
+# Sharded parallel ingestion
+# ---------------------------------------------------------------------------
+SHARD_SIZE = 1 << 24
+
+_ID2IDX = None
+
+
+def _byte_ranges(path, n_shards):
+    size = os.path.getsize(path)
+    step = max(1, -(-size // max(1, n_shards)))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def _iter_range_lines(path, start, end, errors):
+    """Yield the lines that *start* inside [start, end) of ``path``."""
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                # the line straddling ``start`` belongs to the previous shard
+                f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8', errors).replace('\r\n', '\n')
+
+
+def _preprocess_line_shard(path, start, end, preprocess):
+    line_ids, texts = [], []
+    for line in _iter_range_lines(path, start, end, 'ignore'):
+        line_id, text = parse_movie_line(line)
+        line_ids.append(line_id)
+        texts.append(preprocess(text) if preprocess is not None else text)
+    return line_ids, texts
+
+
+def _init_pair_worker(id2idx):
+    global _ID2IDX
+    _ID2IDX = id2idx
+
+
+def _pair_shard(path, start, end):
+    src_idx, trg_idx = array('q'), array('q')
+    for line in _iter_range_lines(path, start, end, 'strict'):
+        idx = [_ID2IDX[line_id] for line_id in parse_conversation(line)]
+        src_idx.extend(idx[:-1])
+        trg_idx.extend(idx[1:])
+    return src_idx, trg_idx
+
+
+def process_pool_context():
+    # fork lets workers use preprocess functions defined in the training script
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def load_dialog_pairs_parallel(corpus_dir, preprocess=None, n_workers=None, shard_size=SHARD_SIZE):
+    """Sharded multi-process version of ``iter_dialog_pairs`` + ``preprocess``.
+
+    Both text files of an *extracted* corpus are split into byte ranges that
+    are processed in a ProcessPoolExecutor. Every movie line is preprocessed
+    exactly once (in parallel), the conversation shards only return line
+    indices, and results are merged in shard order, so the output is
+    identical to the single-process loop regardless of ``n_workers``.
+
+    Returns (processed_src, processed_trg) lists.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    lines_path = os.path.join(corpus_dir, MOVIE_LINES)
+    convs_path = os.path.join(corpus_dir, MOVIE_CONVERSATIONS)
+
+    def n_shards(path):
+        return max(n_workers * 4, -(-os.path.getsize(path) // shard_size))
+
+    # 1) line table: parse + preprocess every line once
+    id2idx, texts = {}, []
+    with ProcessPoolExecutor(n_workers, mp_context=process_pool_context()) as pool:
+        futures = [pool.submit(_preprocess_line_shard, lines_path, start, end, preprocess)
+                   for start, end in _byte_ranges(lines_path, n_shards(lines_path))]
+        for future in futures:
+            line_ids, shard_texts = future.result()
+            # a repeated line id keeps its last text, as in a plain dict build
+            for i, line_id in enumerate(line_ids, len(texts)):
+                id2idx[line_id] = i
+            texts.extend(shard_texts)
+
+    # 2) conversations: shards only send back (src, trg) line indices
+    src_idx, trg_idx = [], []
+    with ProcessPoolExecutor(n_workers, mp_context=process_pool_context(),
+                             initializer=_init_pair_worker, initargs=(id2idx,)) as pool:
+        futures = [pool.submit(_pair_shard, convs_path, start, end)
+                   for start, end in _byte_ranges(convs_path, n_shards(convs_path))]
+        for future in futures:
+            shard_src, shard_trg = future.result()
+            src_idx.extend(shard_src)
+            trg_idx.extend(shard_trg)
+
+    processed_src = [texts[i] for i in src_idx]
+    processed_trg = [texts[i] for i in trg_idx]
+    return processed_src, processed_trg
@@ -0,0 +1,118 @@
+"""
+Binary pre-parsed store for the Cornell dialog corpus.
+
+Parsing ``movie_lines.txt`` and walking ``movie_conversations.txt`` is done
+once; the result is written next to the corpus cache as
+
+    text.bin      UTF-8 bytes of every line, concatenated
+    offsets.npy   int64 (n_lines + 1,) byte offsets into text.bin
+    pairs.npy     int32 (n_pairs, 2)   (src line, trg line) indices
+    meta.json     format version, source checksum and counts
+
+All arrays are memory-mapped on load, so later runs open 300k+ lines in
+milliseconds instead of re-splitting the text files.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+from cornell_corpus import (default_cache_dir, archive_sha256, iter_corpus_lines,
+                            iter_conversations, parse_movie_line, MOVIE_LINES)
+
+STORE_VERSION = 1
+
+
+class CorpusStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.pairs = np.load(os.path.join(path, 'pairs.npy'), mmap_mode='r')
+        if self.meta['n_bytes'] > 0:
+            self.text = np.memmap(os.path.join(path, 'text.bin'), dtype=np.uint8, mode='r')
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def n_lines(self):
+        return len(self.offsets) - 1
+
+    def line(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.text[start:end].tobytes().decode('utf-8')
+
+    def pair(self, idx):
+        src, trg = self.pairs[idx]
+        return self.line(src), self.line(trg)
+
+    def iter_pairs(self):
+        """ same order as cornell_corpus.iter_dialog_pairs """
+        for src, trg in self.pairs:
+            yield self.line(src), self.line(trg)
+
+
+def compile_corpus_store(source, path, source_sha256=None):
+    """Parse ``source`` (zip or extracted directory) once and write a store at ``path``."""
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # line table, in file order; a repeated line id keeps its last text
+    id2idx = {}
+    offsets = [0]
+    with open(os.path.join(tmp_path, 'text.bin'), 'wb') as text_file:
+        for line in iter_corpus_lines(source, MOVIE_LINES, errors='ignore'):
+            line_id, text = parse_movie_line(line)
+            data = text.encode('utf-8')
+            text_file.write(data)
+            id2idx[line_id] = len(offsets) - 1
+            offsets.append(offsets[-1] + len(data))
+
+    # (src_line, trg_line) index of every adjacent utterance pair
+    pairs = []
+    for conversation in iter_conversations(source):
+        idx = [id2idx[line_id] for line_id in conversation]
+        pairs.extend(zip(idx[:-1], idx[1:]))
+
+    np.save(os.path.join(tmp_path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, 'pairs.npy'),
+            np.asarray(pairs, dtype=np.int32).reshape(-1, 2))
+
+    meta = {'version': STORE_VERSION,
+            'source_sha256': source_sha256,
+            'n_lines': len(offsets) - 1,
+            'n_pairs': len(pairs),
+            'n_bytes': offsets[-1]}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return CorpusStore(path)
+
+
+def open_corpus_store(zip_path, cache_dir=None):
+    """Open the store compiled from ``zip_path``, compiling it on first use.
+
+    Stores are keyed by the archive checksum, so a new corpus version gets
+    its own store and a stale one is never read.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    sha256 = archive_sha256(zip_path)
+
+    path = os.path.join(cache_dir, 'store', sha256)
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get('version') == STORE_VERSION:
+                return CorpusStore(path)
+    return compile_corpus_store(zip_path, path, sha256)
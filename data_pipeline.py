@@ -0,0 +1,402 @@
+"""
+Vectorized stages that turn the normalized (SRC, TRG) pairs into the
+training sample used by the chatbot scripts.
+
+Run ``python data_pipeline.py`` to benchmark the stages against the
+original per-row pandas loops on the full Cornell corpus.
+"""
+import math
+import random
+import sqlite3
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+def word_lengths(series):
+    """Number of space separated words of every sentence, as int32.
+
+    Same as ``len(str(x).split())`` for text produced by ``preprocess_eng``
+    (single spaces, no leading / trailing whitespace), without touching the
+    rows one at a time.
+    """
+    series = series.astype(str)
+    counts = series.str.count(' ').to_numpy(dtype=np.int32) + 1
+    counts[(series == '').to_numpy()] = 0
+    return pd.Series(counts, index=series.index, dtype=np.int32)
+
+
+def word_lengths_reference(train_df):
+    """ original per-row loop, kept for benchmarks """
+    # object columns, as with older pandas (a str column would reject the ints)
+    train_df["src_len"] = pd.Series("", index=train_df.index, dtype=object)
+    train_df["trg_len"] = pd.Series("", index=train_df.index, dtype=object)
+    for idx in range(len(train_df['SRC'])):
+        text_eng = str(train_df.iloc[idx]['SRC'])
+        train_df.at[idx, 'src_len'] = int(len(text_eng.split()))
+        text_fra = str(train_df.iloc[idx]['TRG'])
+        train_df.at[idx, 'trg_len'] = int(len(text_fra.split()))
+    return train_df
+
+
+def within_len(train_df, min_len=4, max_len=20):
+    """ min_len < src_len, trg_len <= max_len """
+    src_len = train_df['src_len'].to_numpy()
+    trg_len = train_df['trg_len'].to_numpy()
+    return pd.Series((min_len < src_len) & (src_len <= max_len) &
+                     (min_len < trg_len) & (trg_len <= max_len), index=train_df.index)
+
+
+# ---------------------------------------------------------------------------
+# Streaming deduplication
+# ---------------------------------------------------------------------------
+def hash64(text):
+    """ stable 64-bit hash of a string (same value in every process / run) """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashSet(object):
+    """ exact in-memory set of 64-bit hashes """
+
+    def __init__(self):
+        self.seen = set()
+
+    def add(self, h):
+        """ add ``h``, return True if it was not there yet """
+        if h in self.seen:
+            return False
+        self.seen.add(h)
+        return True
+
+
+class BloomFilter(object):
+    """Fixed-size approximate set: memory does not grow with the corpus.
+
+    A false positive drops a unique sentence with probability ``error_rate``
+    once ``capacity`` items have been added; duplicates are never kept.
+    """
+
+    def __init__(self, capacity, error_rate=1e-4):
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def add(self, h):
+        # double hashing on the two 32-bit halves
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        new = False
+        for i in range(self.n_hashes):
+            bit = (h1 + i * h2) % self.n_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                new = True
+        return new
+
+
+class DiskHashSet(object):
+    """ exact set of 64-bit hashes kept in an SQLite file, for corpora whose hashes do not fit in RAM """
+
+    def __init__(self, path, commit_every=100000):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen (h INTEGER PRIMARY KEY)')
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def add(self, h):
+        # SQLite integers are signed
+        cursor = self.conn.execute('INSERT OR IGNORE INTO seen VALUES (?)',
+                                   (h - (1 << 64) if h >= 1 << 63 else h,))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.conn.commit()
+            self.pending = 0
+        return cursor.rowcount == 1
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def dedup_pairs(pairs, src_seen=None, trg_seen=None):
+    """Streaming equivalent of
+
+        train_df.drop_duplicates(subset=["SRC"]).drop_duplicates(subset=["TRG"])
+
+    Yields the (src, trg) pairs whose SRC has not been seen before and whose
+    TRG has not been seen among the pairs that passed the SRC check, i.e.
+    the first occurrence is kept. Only 64-bit hashes of the sentences are
+    stored, in ``HashSet`` (default), ``BloomFilter`` or ``DiskHashSet``.
+    """
+    src_seen = src_seen if src_seen is not None else HashSet()
+    trg_seen = trg_seen if trg_seen is not None else HashSet()
+    for src, trg in pairs:
+        if not src_seen.add(hash64(src)):
+            continue
+        if not trg_seen.add(hash64(trg)):
+            continue
+        yield src, trg
+
+
+# ---------------------------------------------------------------------------
+# Near-duplicate filtering (MinHash + LSH)
+# ---------------------------------------------------------------------------
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def _shingle_hashes(texts, shingle):
+    """Character ``shingle``-grams of every text as values < 2**31.
+
+    Returns (values, offsets): the shingles of text i are
+    ``values[offsets[i]:offsets[i + 1]]``. Everything is computed on one
+    concatenated byte buffer; texts shorter than a shingle are padded.
+    """
+    encoded = [text.encode('utf-8').ljust(shingle) for text in texts]
+    lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+    buf = np.frombuffer(b''.join(encoded), dtype=np.uint8).astype(np.int64)
+
+    # polynomial hash of every window, mod p
+    n_windows = len(buf) - shingle + 1
+    values = np.zeros(max(0, n_windows), dtype=np.int64)
+    for i in range(shingle):
+        values = (values * 257 + buf[i:i + n_windows]) % _MERSENNE_PRIME
+
+    # keep the windows that lie inside a single text
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    counts = lengths - shingle + 1
+    index = np.repeat(starts, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return values[index], offsets
+
+
+def minhash_signatures(texts, num_perm=64, shingle=4, seed=1234):
+    """(len(texts), num_perm) uint32 MinHash signatures over character shingles.
+
+    The permutations are multiply-shift hashes ``(a * x + b) >> 32`` on
+    uint64 (wrap-around arithmetic), vectorized over all shingles of all
+    texts and reduced per text with ``np.minimum.reduceat``.
+    """
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    if len(texts) == 0:
+        return signatures
+
+    values, offsets = _shingle_hashes(texts, shingle)
+    values = values.astype(np.uint64)
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    permuted = np.empty_like(values)
+    for p in range(num_perm):
+        np.multiply(values, a[p], out=permuted)
+        permuted += b[p]
+        permuted >>= np.uint64(32)
+        signatures[:, p] = np.minimum.reduceat(permuted, offsets[:-1])
+    return signatures
+
+
+def lsh_bands(num_perm, threshold):
+    """ (bands, rows) with bands * rows == num_perm whose S-curve crosses ``threshold`` closest """
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(options, key=lambda br: abs((1.0 / br[0]) ** (1.0 / br[1]) - threshold))
+
+
+class NearDuplicateIndex(object):
+    """LSH index of the kept MinHash signatures, first occurrence wins.
+
+    ``add(signature)`` returns False when the signature shares an LSH bucket
+    with an already kept one whose estimated Jaccard similarity (fraction
+    of equal MinHash values) is at least ``threshold``; otherwise the
+    signature is kept and True is returned. Only kept signatures are stored.
+    """
+
+    def __init__(self, num_perm=64, threshold=0.8):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.buckets = [dict() for _ in range(self.bands)]
+        self.kept = []
+
+    def add(self, signature):
+        keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        candidates = set()
+        for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        if candidates:
+            kept = np.stack([self.kept[i] for i in candidates])
+            if ((kept == signature).mean(axis=1) >= self.threshold).any():
+                return False
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, []).append(len(self.kept))
+        self.kept.append(signature)
+        return True
+
+
+def near_duplicate_mask(signatures, threshold=0.8):
+    """ boolean mask of the rows ``NearDuplicateIndex`` keeps, in row order """
+    index = NearDuplicateIndex(signatures.shape[1], threshold)
+    return np.fromiter((index.add(signature) for signature in signatures), dtype=bool, count=len(signatures))
+
+
+def near_dedup(train_df, columns=('SRC', 'TRG'), threshold=0.8, num_perm=64, shingle=4, seed=1234):
+    """Drop near-duplicate rows column by column, like the exact drop_duplicates passes."""
+    for column in columns:
+        signatures = minhash_signatures(train_df[column].astype(str).tolist(), num_perm, shingle, seed)
+        train_df = train_df[near_duplicate_mask(signatures, threshold)]
+    return train_df
+
+
+def near_dedup_pairs(pairs, threshold=0.8, num_perm=64, shingle=4, seed=1234, chunk_size=4096):
+    """Streaming version of ``near_dedup`` over (src, trg) pairs, with the same result.
+
+    Signatures are computed ``chunk_size`` pairs at a time; like
+    ``dedup_pairs``, a question is remembered even if its answer is then
+    dropped. Memory grows with the number of kept pairs, not the stream.
+    """
+    src_index = NearDuplicateIndex(num_perm, threshold)
+    trg_index = NearDuplicateIndex(num_perm, threshold)
+    pairs = iter(pairs)
+    while True:
+        chunk = [pair for _, pair in zip(range(chunk_size), pairs)]
+        if not chunk:
+            return
+        src_signatures = minhash_signatures([src for src, _ in chunk], num_perm, shingle, seed)
+        trg_signatures = minhash_signatures([trg for _, trg in chunk], num_perm, shingle, seed)
+        for pair, src_signature, trg_signature in zip(chunk, src_signatures, trg_signatures):
+            if src_index.add(src_signature) and trg_index.add(trg_signature):
+                yield pair
+
+
+# ---------------------------------------------------------------------------
+# Sampling
+# ---------------------------------------------------------------------------
+SAMPLE_MODES = ('full', 'random', 'reservoir', 'stratified')
+
+
+def filter_pairs_by_len(pairs, min_len=4, max_len=20):
+    """ streaming version of ``within_len`` """
+    for src, trg in pairs:
+        src_len, trg_len = len(src.split()), len(trg.split())
+        if min_len < src_len <= max_len and min_len < trg_len <= max_len:
+            yield src, trg
+
+
+# end of stream marker for ``next`` (an item may itself be None)
+_END = object()
+
+
+def reservoir_sample(items, n, seed=1234):
+    """Uniform sample of ``n`` items from a stream of unknown length (Algorithm L).
+
+    Memory is O(n) and the random generator is only consulted for the items
+    that actually enter the reservoir.
+    """
+    if n <= 0:
+        return []
+    rng = random.Random(seed)
+    items = iter(items)
+    reservoir = []
+    for item in items:
+        reservoir.append(item)
+        if len(reservoir) == n:
+            break
+    if len(reservoir) < n:
+        return reservoir
+
+    def uniform():
+        # (0, 1), keeps the logarithms finite
+        return rng.random() or 5e-324
+
+    w = math.exp(math.log(uniform()) / n)
+    while True:
+        skip = int(math.log(uniform()) / math.log1p(-w)) if w < 1 else 0
+        for _ in range(skip):
+            if next(items, _END) is _END:
+                return reservoir
+        item = next(items, _END)
+        if item is _END:
+            return reservoir
+        reservoir[rng.randrange(n)] = item
+        w *= math.exp(math.log(uniform()) / n)
+
+
+def stratified_sample(train_df, n, boundaries=(8, 12, 16), seed=1234):
+    """Sample ``n`` rows keeping the share of every length bucket.
+
+    Rows are bucketed by ``max(src_len, trg_len)`` at ``boundaries``; each
+    bucket contributes in proportion to its size (largest remainder
+    rounding), so bucketed batching sees the same length mix as the corpus.
+    """
+    lengths = np.maximum(train_df['src_len'].to_numpy(), train_df['trg_len'].to_numpy())
+    buckets = np.digitize(lengths, boundaries)
+    sizes = np.bincount(buckets, minlength=len(boundaries) + 1)
+
+    quota = sizes / max(1, sizes.sum()) * min(n, len(train_df))
+    counts = np.floor(quota).astype(np.int64)
+    remainder = int(min(n, len(train_df)) - counts.sum())
+    counts[np.argsort(counts - quota)[:remainder]] += 1
+
+    rng = np.random.RandomState(seed)
+    picked = [rng.choice(np.flatnonzero(buckets == b), count, replace=False)
+              for b, count in enumerate(counts) if count > 0]
+    picked = np.concatenate(picked) if picked else np.zeros(0, dtype=np.int64)
+    return train_df.iloc[rng.permutation(picked)]
+
+
+def sample_pairs(train_df, n, mode='random', seed=1234):
+    """Pick the training rows from the filtered DataFrame.
+
+    full       : every row
+    random     : ``train_df.sample(n, random_state=seed)``, the original behaviour
+    reservoir  : rows were already sampled from the stream by ``reservoir_sample``
+    stratified : ``stratified_sample``
+    """
+    if mode not in SAMPLE_MODES:
+        raise ValueError('Unknown sample mode {!r}, expected one of {}'.format(mode, SAMPLE_MODES))
+    if mode in ('full', 'reservoir'):
+        return train_df
+    if mode == 'stratified':
+        return stratified_sample(train_df, n, seed=seed)
+    return train_df.sample(n=n, random_state=seed)
+
+
+def _timeit(fn, *args):
+    import time
+
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    from cornell_corpus import fetch_corpus
+    from corpus_store import open_corpus_store
+    from text_preprocessing import cached_preprocess
+
+    normalize = cached_preprocess()
+    store = open_corpus_store(fetch_corpus())
+    pairs = [(normalize(src), normalize(trg)) for src, trg in store.iter_pairs()]
+    train_df = pd.DataFrame(pairs, columns=['SRC', 'TRG'])
+    print('Pairs :', len(train_df))
+
+    loop_df, loop_time = _timeit(word_lengths_reference, train_df.copy())
+    fast_df = train_df.copy()
+
+    def vectorized(df):
+        df['src_len'] = word_lengths(df['SRC'])
+        df['trg_len'] = word_lengths(df['TRG'])
+        return df
+
+    fast_df, fast_time = _timeit(vectorized, fast_df)
+    same = ((loop_df['src_len'].astype(np.int64) == fast_df['src_len']).all() and
+            (loop_df['trg_len'].astype(np.int64) == fast_df['trg_len']).all())
+    print('Identical lengths  :', same)
+    print('Identical filter   :', (within_len(loop_df) == within_len(fast_df)).all())
+    print('per-row loop       : {:.3f} s'.format(loop_time))
+    print('vectorized         : {:.3f} s ({:.0f}x)'.format(fast_time, loop_time / fast_time))
+    dedup_df, dedup_time = _timeit(near_dedup, fast_df)
+    stream_pairs, stream_time = _timeit(lambda df: list(near_dedup_pairs(zip(df['SRC'], df['TRG']))), fast_df)
+    print('Identical near-dup :', stream_pairs == list(zip(dedup_df['SRC'], dedup_df['TRG'])))
+    print('near_dedup         : {:.3f} s, streaming {:.3f} s'.format(dedup_time, stream_time))
+    # an empty frame (e.g. everything filtered out by within_len) stays empty
+    print('Empty near_dedup   :', len(near_dedup(pd.DataFrame({'SRC': [], 'TRG': []}))) == 0)
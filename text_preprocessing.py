@@ -0,0 +1,244 @@
+"""
+English sentence normalization shared by the chatbot scripts.
+
+``preprocess_eng`` produces exactly the same output as the original chain of
+~22 ``re.sub`` calls (kept below as ``preprocess_eng_reference``) in two
+passes over the string:
+
+  1. every contraction is expanded by a single precompiled alternation
+     regex backed by a lookup table,
+  2. the result is split into words (``[a-zA-Z]+``) and punctuation
+     (``[?.!,]``) and joined with single spaces, which is what the
+     punctuation spacing, quote collapsing and character stripping steps
+     of the reference amount to.
+
+It is used for the training corpus and for ``evaluate()`` requests alike.
+``preprocess_eng_tf`` and ``preprocess_eng_series`` apply the same
+normalization to a whole tf.string tensor (e.g. inside ``Dataset.map``) or a
+pandas column at once, and ``export_normalizer`` saves the graph version as
+a SavedModel for serving.
+
+Run ``python text_preprocessing.py`` to check equivalence and measure
+throughput on the full Cornell corpus.
+"""
+import re
+import functools
+
+# Contraction rewrites in the order the reference applies them.
+CONTRACTIONS = [
+    ("i'm", "i am"),
+    ("he's", "he is"),
+    ("she's", "she is"),
+    ("it's", "it is"),
+    ("that's", "that is"),
+    ("what's", "that is"),
+    ("where's", "where is"),
+    ("how's", "how is"),
+    ("'ll", " will"),
+    ("'ve", " have"),
+    ("'re", " are"),
+    ("'d", " would"),
+    ("won't", "will not"),
+    ("can't", "cannot"),
+    ("n't", " not"),
+    ("n'", "ng"),
+    ("'bout", "about"),
+]
+
+# A single left-to-right pass prefers the leftmost match, while the
+# sequential rewrites see the text as changed by the earlier rules:
+#   - "'ll", "'ve", "'re" and "'d" win over the later "n'" rule
+#     ("goin'd" -> "goin would", not "going d"),
+#   - "that's" / "what's" are expanded first, so a preceding "n'", "won'"
+#     or "can'" then matches the "t" of "that is" ("n'what's" -> " nothat is").
+# Spelling those overlaps out keeps both behaviours identical.
+def _sequential(text):
+    for key, value in CONTRACTIONS:
+        text = text.replace(key, value)
+    return text
+
+
+_OVERLAPS = ["n'll", "n've", "n're", "n'd"] + [
+    prefix + suffix for prefix in ("n'", "won'", "can'") for suffix in ("that's", "what's")]
+
+_CONTRACTION_TABLE = dict(CONTRACTIONS)
+_CONTRACTION_TABLE.update((key, _sequential(key)) for key in _OVERLAPS)
+# Longer alternatives first so that e.g. "n't" is tried before "n'".
+_CONTRACTION_RE = re.compile('|'.join(
+    re.escape(key) for key in sorted(_CONTRACTION_TABLE, key=len, reverse=True)))
+_TOKEN_RE = re.compile(r"[a-zA-Z]+|[?.!,]")
+
+
+def _expand(match):
+    return _CONTRACTION_TABLE[match.group(0)]
+
+
+def preprocess_eng(sentence):
+    sentence = sentence.lower()
+    # every contraction contains an apostrophe
+    if "'" in sentence:
+        sentence = _CONTRACTION_RE.sub(_expand, sentence)
+    # keep (a-z, A-Z, ".", "?", "!", ","), one space between words and punctuation
+    return ' '.join(_TOKEN_RE.findall(sentence))
+
+
+def preprocess_eng_reference(sentence):
+    """ original sequential implementation, kept for equivalence checks """
+    sentence = sentence.lower().strip()
+    # creating a space between a word and the punctuation following it
+    # eg: "he is a boy." => "he is a boy ."
+    sentence = re.sub(r"([?.!,])", r" \1 ", sentence)
+    sentence = re.sub(r'[" "]+', " ", sentence)
+    # removing contractions
+    sentence = re.sub(r"i'm", "i am", sentence)
+    sentence = re.sub(r"he's", "he is", sentence)
+    sentence = re.sub(r"she's", "she is", sentence)
+    sentence = re.sub(r"it's", "it is", sentence)
+    sentence = re.sub(r"that's", "that is", sentence)
+    sentence = re.sub(r"what's", "that is", sentence)
+    sentence = re.sub(r"where's", "where is", sentence)
+    sentence = re.sub(r"how's", "how is", sentence)
+    sentence = re.sub(r"\'ll", " will", sentence)
+    sentence = re.sub(r"\'ve", " have", sentence)
+    sentence = re.sub(r"\'re", " are", sentence)
+    sentence = re.sub(r"\'d", " would", sentence)
+    sentence = re.sub(r"\'re", " are", sentence)
+    sentence = re.sub(r"won't", "will not", sentence)
+    sentence = re.sub(r"can't", "cannot", sentence)
+    sentence = re.sub(r"n't", " not", sentence)
+    sentence = re.sub(r"n'", "ng", sentence)
+    sentence = re.sub(r"'bout", "about", sentence)
+    # replacing everything with space except (a-z, A-Z, ".", "?", "!", ",")
+    sentence = re.sub(r"[^a-zA-Z?.!,]+", " ", sentence)
+    sentence = sentence.strip()
+    return sentence
+
+
+def cached_preprocess(maxsize=1 << 16, fn=preprocess_eng):
+    """Bounded LRU memo in front of ``fn``.
+
+    In a conversation every middle utterance is both an answer and the next
+    question, and short lines ("yes .", "what ?") recur thousands of times,
+    so ingestion only normalizes about half of the lines it sees.
+    ``cache_info()`` reports hits / misses.
+    """
+    return functools.lru_cache(maxsize=maxsize)(fn)
+
+
+def cache_hit_rate(cached_fn):
+    info = cached_fn.cache_info()
+    total = info.hits + info.misses
+    return info.hits / total if total else 0.0
+
+
+# Column-wise versions. The TF graph op replays the reference rules with
+# RE2 (no callbacks there), the pandas one reuses the single-pass regexes.
+_TF_RULES = ([(r"([?.!,])", r" \1 "), (r'[" "]+', " ")]
+             + [(re.escape(key), value) for key, value in CONTRACTIONS]
+             + [(r"[^a-zA-Z?.!,]+", " ")])
+
+
+def preprocess_eng_tf(sentences):
+    """``preprocess_eng`` over a tf.string tensor of any shape, inside the graph.
+
+    Usable in ``tf.data.Dataset.map``; lower-casing is done with the UTF-8
+    aware ``tf.strings.lower``.
+    """
+    import tensorflow as tf
+
+    sentences = tf.strings.lower(sentences, encoding='utf-8')
+    for pattern, rewrite in _TF_RULES:
+        sentences = tf.strings.regex_replace(sentences, pattern, rewrite)
+    return tf.strings.strip(sentences)
+
+
+def preprocess_eng_series(series):
+    """ ``preprocess_eng`` over a pandas Series of strings """
+    series = series.str.lower().str.replace(_CONTRACTION_RE, _expand, regex=True)
+    return series.str.findall(_TOKEN_RE).str.join(' ')
+
+
+def build_normalizer_module():
+    """``tf.Module`` that runs ``preprocess_eng_tf`` behind a fixed string signature.
+
+    Save it with ``tf.saved_model.save`` (see ``export_normalizer``) or call
+    it in front of the tokenizer so a serving model normalizes its requests
+    inside the graph, with the same rules that were used for training.
+    """
+    import tensorflow as tf
+
+    class Normalizer(tf.Module):
+
+        @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+        def __call__(self, sentences):
+            return preprocess_eng_tf(sentences)
+
+    return Normalizer()
+
+
+def export_normalizer(export_dir):
+    import tensorflow as tf
+
+    normalizer = build_normalizer_module()
+    tf.saved_model.save(normalizer, export_dir)
+    return export_dir
+
+
+def check_equivalence(sentences):
+    """ return the sentences on which preprocess_eng differs from the reference """
+    return [s for s in sentences if preprocess_eng(s) != preprocess_eng_reference(s)]
+
+
+def _column_versions():
+    import pandas as pd
+    import tensorflow as tf
+
+    def series(sentences):
+        return preprocess_eng_series(pd.Series(sentences)).tolist()
+
+    def graph(sentences):
+        outputs = preprocess_eng_tf(tf.constant(sentences, dtype=tf.string)).numpy()
+        return [s.decode('utf-8') for s in outputs]
+
+    return [('pandas .str', series), ('tf.strings', graph)]
+
+
+def benchmark(sentences, repeat=3):
+    """ best-of-``repeat`` sentences/sec of every normalizer """
+    import time
+
+    def loop(fn):
+        return lambda batch: [fn(s) for s in batch]
+
+    versions = [('reference', loop(preprocess_eng_reference)),
+                ('preprocess_eng', loop(preprocess_eng))] + _column_versions()
+    results = {}
+    for name, fn in versions:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(sentences)
+            best = min(best, time.perf_counter() - start)
+        results[name] = len(sentences) / best
+    return results
+
+
+if __name__ == '__main__':
+    from cornell_corpus import fetch_corpus
+    from corpus_store import open_corpus_store
+
+    store = open_corpus_store(fetch_corpus())
+    sentences = [store.line(i) for i in range(store.n_lines)]
+    expected = [preprocess_eng_reference(s) for s in sentences]
+
+    print('Sentences  :', len(sentences))
+    mismatches = check_equivalence(sentences)
+    print('Mismatches :', len(mismatches))
+    for s in mismatches[:10]:
+        print('  ', repr(s))
+    for name, fn in _column_versions():
+        outputs = fn(sentences)
+        print('Mismatches ({}) :'.format(name), sum(a != b for a, b in zip(outputs, expected)))
+
+    for name, rate in benchmark(sentences).items():
+        print('{:<15}: {:>10.0f} sentences/sec'.format(name, rate))
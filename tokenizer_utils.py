@@ -0,0 +1,771 @@
+"""
+Tokenizer helpers shared by the chatbot scripts.
+
+``build_subword_tokenizer`` is a drop-in replacement for
+``tfds.deprecated.text.SubwordTextEncoder.build_from_corpus`` that
+
+  * counts the corpus tokens once, split across worker processes,
+  * runs the same min_count binary search on those counts, and
+  * caches the resulting vocab file keyed by a hash of the corpus and the
+    build arguments, so later runs only call ``load_from_file``.
+
+``batch_tokenizer`` wraps a fitted Keras ``Tokenizer`` or a
+``SubwordTextEncoder`` so a whole list of sentences is encoded at once into
+a ``tf.RaggedTensor`` with the same ids as ``texts_to_sequences`` /
+``encode``. ``tf_encode`` does the same on a string tensor inside
+``tf.data.Dataset.map``. ``pack_pairs`` turns the ragged question / answer
+ids into the padded source, target and segment tensors of the GPT2 / BERT
+scripts in one pass, with explicit handling of pairs that do not fit.
+``pack_sequences`` fills each of those rows with several examples for the
+packed training mode. ``compact_ids`` stores the padded ids as int16 /
+int32 (``id_dtype``) instead of int64.
+
+``FastSubwordEncoder`` wraps a ``SubwordTextEncoder`` and encodes with a
+character trie over its vocabulary and a per-word LRU cache, returning the
+same ids as ``encode``.
+
+``save_tokenizer`` / ``load_tokenizer`` store a fitted Keras ``Tokenizer``
+as a small JSON artifact (vocabulary in id order plus the text settings,
+no word counts) next to the checkpoints; the ``FrozenTokenizer`` it loads
+back encodes and decodes exactly like the original.
+
+``vocab_coverage`` reports how much of the fitted corpus a top-K
+(``num_words``) vocabulary covers; ``python tokenizer_utils.py`` prints the
+OOV rate against output-layer size and softmax step time for several K.
+
+``SpecialTokenizer`` gives PAD / SOS / EOS / CLS / SEP / MASK fixed ids
+next to any of these tokenizers and reports the exact vocabulary size.
+"""
+import os
+import re
+import json
+import time
+import itertools
+import functools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from cornell_corpus import default_cache_dir, process_pool_context, corpus_key
+
+try:
+    import tensorflow_datasets as tfds
+    from tensorflow_datasets.core.deprecated.text import subword_text_encoder
+    SubwordTextEncoder = tfds.deprecated.text.SubwordTextEncoder
+except ImportError:  # only the subword scripts need tfds
+    subword_text_encoder = SubwordTextEncoder = None
+
+# A word followed by exactly one space (encoded as "word_"), a word, or a
+# run of non-word characters: the tokens of SubwordTextEncoder after its
+# single spaces have been folded into the preceding word.
+_SUBWORD_PIECE_RE = re.compile(r"\w+ (?!\W)|\w+|\W+")
+_WORD_RE = re.compile(r"\w")
+
+
+def _count_chunk(chunk, reserved_tokens):
+    return subword_text_encoder._token_counts_from_generator(
+        generator=chunk, max_chars=None, reserved_tokens=reserved_tokens)
+
+
+def count_subword_tokens(corpus, reserved_tokens=None, n_workers=None):
+    """Token counts of ``corpus`` as built by SubwordTextEncoder, counted in parallel."""
+    corpus = list(corpus)
+    reserved_tokens = reserved_tokens or []
+    n_workers = min(n_workers or os.cpu_count() or 1, max(1, len(corpus)))
+    if n_workers <= 1:
+        return _count_chunk(corpus, reserved_tokens)
+
+    step = -(-len(corpus) // n_workers)
+    token_counts = collections.defaultdict(int)
+    with ProcessPoolExecutor(n_workers, mp_context=process_pool_context()) as pool:
+        futures = [pool.submit(_count_chunk, corpus[start:start + step], reserved_tokens)
+                   for start in range(0, len(corpus), step)]
+        for future in futures:
+            for token, count in future.result().items():
+                token_counts[token] += count
+    return token_counts
+
+
+def build_subword_from_token_counts(token_counts, target_vocab_size,
+                                    max_subword_length=20, reserved_tokens=None):
+    """ the min_token_count binary search of SubwordTextEncoder.build_from_corpus """
+    reserved_tokens = reserved_tokens or []
+
+    def _binary_search(min_token_count, max_token_count):
+        candidate_min = (min_token_count + max_token_count) // 2
+        encoder = SubwordTextEncoder._build_from_token_counts(
+            token_counts=token_counts,
+            min_token_count=candidate_min,
+            reserved_tokens=reserved_tokens,
+            num_iterations=4,
+            max_subword_length=max_subword_length)
+        vocab_size = encoder.vocab_size
+
+        # Being within 1% of the target vocab size is ok
+        target_achieved = abs(vocab_size - target_vocab_size) * 100 < target_vocab_size
+        if target_achieved or min_token_count >= max_token_count or candidate_min <= 1:
+            return encoder
+
+        if vocab_size > target_vocab_size:
+            next_encoder = _binary_search(candidate_min + 1, max_token_count)
+        else:
+            next_encoder = _binary_search(min_token_count, candidate_min - 1)
+
+        # Return the one that's closest to the target_vocab_size
+        if abs(vocab_size - target_vocab_size) < abs(next_encoder.vocab_size - target_vocab_size):
+            return encoder
+        return next_encoder
+
+    min_token_count = max(min(token_counts.values()), 1)
+    max_token_count = max(token_counts.values())
+    return _binary_search(min_token_count, max_token_count)
+
+
+def build_subword_tokenizer(corpus, target_vocab_size=2**13, max_subword_length=20,
+                            reserved_tokens=None, cache_dir=None, n_workers=None):
+    """Cached, parallel-counted ``SubwordTextEncoder.build_from_corpus``.
+
+    Returns the same vocabulary as ``build_from_corpus(corpus, target_vocab_size)``.
+    """
+    corpus = list(corpus)
+    reserved_tokens = list(reserved_tokens or [])
+    cache_dir = os.path.join(cache_dir or default_cache_dir(), 'vocab')
+    key = corpus_key(corpus, 'subword', target_vocab_size, max_subword_length, reserved_tokens)
+    filename_prefix = os.path.join(cache_dir, key)
+
+    if os.path.exists(filename_prefix + '.subwords'):
+        return SubwordTextEncoder.load_from_file(filename_prefix)
+
+    token_counts = count_subword_tokens(corpus, reserved_tokens, n_workers)
+    encoder = build_subword_from_token_counts(
+        token_counts, target_vocab_size, max_subword_length, reserved_tokens)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    encoder.save_to_file(filename_prefix)
+    return encoder
+
+
+def add_special_tokens(ids, prefix=(), suffix=()):
+    """ ``prefix + row + suffix`` for every row of a ragged id tensor """
+    parts = []
+    n_rows = ids.nrows()
+    for tokens in (prefix, None, suffix):
+        if tokens is None:
+            parts.append(ids)
+        elif len(tokens):
+            row = tf.constant(list(tokens), dtype=ids.dtype)
+            parts.append(tf.RaggedTensor.from_tensor(
+                tf.tile(row[tf.newaxis], [n_rows, 1])))
+    return tf.concat(parts, axis=1) if len(parts) > 1 else ids
+
+
+def pad_ragged(ids, maxlen, truncating='post', value=0):
+    """``pad_sequences(..., maxlen=maxlen, padding='post')`` for a ragged id tensor.
+
+    ``truncating='pre'`` keeps the last ``maxlen`` ids of longer rows, like
+    the pad_sequences default.
+    """
+    if truncating == 'pre':
+        lengths = ids.row_lengths()
+        start = tf.maximum(lengths - maxlen, 0)
+        positions = tf.ragged.range(start, lengths)
+        ids = tf.gather(ids.flat_values, positions + ids.row_starts()[:, tf.newaxis])
+    else:
+        ids = ids[:, :maxlen]
+    return ids.to_tensor(default_value=value, shape=[None, maxlen])
+
+
+def _take_ragged(ids, lengths):
+    """ the first ``lengths[i]`` ids of every row """
+    positions = tf.ragged.range(tf.zeros_like(lengths), lengths)
+    return tf.gather(ids.flat_values, positions + ids.row_starts()[:, tf.newaxis])
+
+
+def _truncate_ragged(ids, lengths):
+    """ ``_take_ragged``, but a row that is cut keeps its last id (SEP / EOS) in its last place """
+    cut = (ids.row_lengths() > lengths) & (lengths > 0)
+    body = _take_ragged(ids, tf.where(cut, lengths - 1, lengths))
+    last = _take_ragged(ids[:, -1:], tf.cast(cut, lengths.dtype))
+    return tf.concat([body, last], axis=1)
+
+
+def pack_pairs(src, trg, maxlen, pad_id=0, src_pad_id=None, overflow='drop'):
+    """Pack (question, answer) id rows into the fixed-length GPT2 / BERT inputs.
+
+    With ``n = len(src)`` and ``m = len(trg)`` every pair becomes
+
+        source   src + [src_pad_id] * (maxlen - n)
+        target   [pad_id] * n + trg + [pad_id] * (maxlen - n - m)
+        segment  [0] * n + [1] * m + [0] * (maxlen - n - m)
+
+    for all rows at once, from ragged id tensors. Pairs with ``n + m >
+    maxlen`` are left out (``overflow='drop'``), cut to fit by shortening
+    the answer, which keeps its last id (SEP / EOS) (``'truncate'``), or
+    raise ``ValueError`` (``'error'``). With ``'truncate'`` a question that
+    leaves no room for its answer drops the pair, as the row would have no
+    target ids. Returns int64 ``(sources, targets,
+    segments, keep)``, where ``keep`` marks the input pairs that were kept.
+    """
+    src = tf.cast(src, tf.int64)
+    trg = tf.cast(trg, tf.int64)
+    src_pad_id = pad_id if src_pad_id is None else src_pad_id
+    n, m = src.row_lengths(), trg.row_lengths()
+    fits = n + m <= maxlen
+
+    if overflow == 'drop':
+        src = tf.ragged.boolean_mask(src, fits)
+        trg = tf.ragged.boolean_mask(trg, fits)
+        keep = fits
+    elif overflow == 'truncate':
+        n = tf.minimum(n, maxlen)
+        keep = (m == 0) | (n < maxlen)
+        src = _truncate_ragged(tf.ragged.boolean_mask(src, keep), tf.boolean_mask(n, keep))
+        trg = tf.ragged.boolean_mask(trg, keep)
+        trg = _truncate_ragged(trg, tf.minimum(trg.row_lengths(), maxlen - src.row_lengths()))
+    elif overflow == 'error':
+        n_over = int(tf.reduce_sum(tf.cast(~fits, tf.int32)))
+        if n_over:
+            raise ValueError('{} of {} pairs are longer than maxlen={}'.format(
+                n_over, len(fits), maxlen))
+        keep = fits
+    else:
+        raise ValueError('unknown overflow mode: {!r}'.format(overflow))
+
+    n, m = src.row_lengths(), trg.row_lengths()
+    sources = src.to_tensor(default_value=src_pad_id, shape=[None, maxlen])
+    # the answer starts right after the question
+    lead = tf.RaggedTensor.from_row_lengths(
+        tf.fill([tf.reduce_sum(n)], tf.constant(pad_id, tf.int64)), n)
+    targets = tf.concat([lead, trg], axis=1).to_tensor(default_value=pad_id, shape=[None, maxlen])
+    positions = tf.range(maxlen, dtype=tf.int64)[tf.newaxis]
+    segments = tf.cast((positions >= n[:, tf.newaxis]) & (positions < (n + m)[:, tf.newaxis]),
+                       tf.int64)
+    return sources, targets, segments, keep
+
+
+def _best_fit(lengths, maxlen):
+    """ row and offset of every item, best-fit decreasing into rows of ``maxlen`` """
+    rows = np.zeros(len(lengths), dtype=np.int64)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    # open rows by their free space, so the best fit is the first non-empty list from ``length`` up
+    by_space = [[] for _ in range(maxlen + 1)]
+    used = []
+    for i in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[i])
+        for space in range(length, maxlen + 1):
+            if by_space[space]:
+                row = by_space[space].pop()
+                break
+        else:
+            row, space = len(used), maxlen
+            used.append(0)
+        rows[i], offsets[i] = row, used[row]
+        used[row] += length
+        by_space[space - length].append(row)
+    return rows, offsets, len(used)
+
+
+def pack_sequences(tensors, lengths, pad_ids=0):
+    """Put several padded rows of the same example layout into each row.
+
+    ``tensors`` are (n, maxlen) id tensors of the same examples (e.g. the
+    source, target and segment rows of ``pack_pairs``) whose content is the
+    first ``lengths[i]`` ids of row ``i``. Examples are placed whole,
+    longest first, into the fullest row that still has room (best-fit
+    decreasing), and every tensor is rebuilt with the same placement;
+    ``pad_ids`` (one per tensor, or one for all) fills the rest. Also
+    returns, for every slot, the 1-based number of its example within the
+    row (0 on padding) and its position inside the example, for the
+    block-diagonal attention mask and the position resets. Returns int64
+    ``(packed_tensors, example_ids, positions)``.
+    """
+    tensors = [np.asarray(tensor) for tensor in tensors]
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if not isinstance(pad_ids, (list, tuple)):
+        pad_ids = [pad_ids] * len(tensors)
+    maxlen = tensors[0].shape[1]
+    keep = lengths > 0
+    tensors = [tensor[keep] for tensor in tensors]
+    lengths = lengths[keep]
+
+    rows, offsets, n_rows = _best_fit(lengths, maxlen)
+    # number of every example within its row, in left-to-right order
+    order = np.lexsort((offsets, rows))
+    starts = np.searchsorted(rows[order], np.arange(n_rows))
+    example_no = np.empty_like(rows)
+    example_no[order] = np.arange(len(order)) - starts[rows[order]] + 1
+
+    columns = np.arange(maxlen)
+    content = columns < lengths[:, np.newaxis]
+    dest = ((rows * maxlen + offsets)[:, np.newaxis] + columns)[content]
+    packed = []
+    for tensor, pad_id in zip(tensors, pad_ids):
+        flat = np.full(n_rows * maxlen, pad_id, dtype=np.int64)
+        flat[dest] = tensor[content]
+        packed.append(tf.constant(flat.reshape(n_rows, maxlen)))
+    example_ids = np.zeros(n_rows * maxlen, dtype=np.int64)
+    example_ids[dest] = np.repeat(example_no, lengths)
+    positions = np.zeros(n_rows * maxlen, dtype=np.int64)
+    positions[dest] = np.broadcast_to(columns, content.shape)[content]
+    return (packed, tf.constant(example_ids.reshape(n_rows, maxlen)),
+            tf.constant(positions.reshape(n_rows, maxlen)))
+
+
+def id_dtype(vocab_size):
+    """ smallest signed integer dtype that holds every id below ``vocab_size`` """
+    if vocab_size <= 2**15:
+        return tf.int16
+    if vocab_size <= 2**31:
+        return tf.int32
+    return tf.int64
+
+
+def compact_ids(*tensors, vocab_size, dtype=None):
+    """Cast padded id tensors to ``id_dtype(vocab_size)`` (or ``dtype``) for storage.
+
+    The dataset cache, the host to device copies and any exported shards
+    then carry 2 or 4 bytes per token instead of 8; the training step casts
+    back to int64 on the device. Returns the tensors in the given order and
+    raises ``ValueError`` if an id does not fit.
+    """
+    dtype = tf.as_dtype(dtype or id_dtype(vocab_size))
+    info = np.iinfo(dtype.as_numpy_dtype)
+    compact = []
+    for tensor in tensors:
+        if tf.size(tensor) and (tf.reduce_min(tensor) < info.min or tf.reduce_max(tensor) > info.max):
+            raise ValueError('ids do not fit in {}'.format(dtype.name))
+        compact.append(tf.cast(tensor, dtype))
+    return compact
+
+
+class KerasTokenizerEncoder(object):
+    """Graph version of ``Tokenizer.texts_to_sequences``.
+
+    Lower-casing, filter characters and splitting run as ``tf.strings`` ops
+    and the word ids come from a ``tf.lookup.StaticHashTable`` built from
+    ``word_index``; words outside the table map to the OOV id (or are
+    dropped when the tokenizer has no ``oov_token``), and ``num_words`` is
+    respected the same way.
+    """
+
+    def __init__(self, tokenizer):
+        if tokenizer.char_level:
+            raise ValueError('char_level tokenizers are not supported')
+        self.lower = tokenizer.lower
+        self.split = tokenizer.split
+        self.filters = tokenizer.filters
+        self.oov_id = tokenizer.word_index.get(tokenizer.oov_token) if tokenizer.oov_token else None
+
+        words, ids = [], []
+        for word, idx in tokenizer.word_index.items():
+            if not tokenizer.num_words or idx < tokenizer.num_words or idx == self.oov_id:
+                words.append(word)
+                ids.append(idx)
+        self.table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(
+                tf.constant(words, dtype=tf.string), tf.constant(ids, dtype=tf.int64)),
+            default_value=-1 if self.oov_id is None else self.oov_id)
+        # RE2 character class of the filter characters
+        self._filter_re = '[' + ''.join('\\x{%x}' % ord(c) for c in self.filters) + ']'
+
+    def tf_encode(self, texts):
+        """ 1-D tf.string tensor -> RaggedTensor of int64 ids """
+        texts = tf.convert_to_tensor(texts, dtype=tf.string)
+        if self.lower:
+            texts = tf.strings.lower(texts, encoding='utf-8')
+        if self.filters:
+            texts = tf.strings.regex_replace(texts, self._filter_re, self.split)
+        words = tf.strings.split(texts, sep=self.split)
+        words = tf.ragged.boolean_mask(words, tf.strings.length(words) > 0)
+        ids = tf.ragged.map_flat_values(self.table.lookup, words)
+        if self.oov_id is None:
+            ids = tf.ragged.boolean_mask(ids, ids >= 0)
+        return ids
+
+    def __call__(self, texts, prefix=(), suffix=()):
+        return add_special_tokens(self.tf_encode(list(texts)), prefix, suffix)
+
+
+class FastSubwordEncoder(object):
+    """Drop-in ``SubwordTextEncoder`` with a faster ``encode``.
+
+    ``SubwordTextEncoder`` splits every word by slicing it from the longest
+    possible candidate down and probing a dict with each slice. Here the
+    vocabulary is compiled once into a character trie, so the greedy
+    longest match is a single walk over the word, and the ids of each word
+    (already shifted by one for padding) are kept in a bounded LRU cache.
+    Sentences are split with one regex that already folds single spaces
+    into the preceding word; vocabularies with reserved (mixed
+    alphanumeric) tokens, and text containing the escaped underscore, go
+    through the tfds splitting instead. Either way the ids are identical.
+    Everything else (``decode``, ``vocab_size``, ``subwords``,
+    ``save_to_file``, ...) is delegated to the wrapped encoder.
+    """
+
+    def __init__(self, tokenizer, cache_size=1 << 18):
+        self.tokenizer = tokenizer
+        subwords = tokenizer._subwords
+        self._n_subwords = len(subwords)
+        self._trie = {}
+        for idx, subword in enumerate(subwords):
+            self._insert(subword, idx)
+        # the escaped underscore always maps to the byte id of "_"
+        self._insert(subword_text_encoder._UNDERSCORE_REPLACEMENT, self._n_subwords + ord('_'))
+        self._split = tokenizer._tokenizer.tokenize
+        # the underscore replacement is always reserved
+        self._plain_split = len(tokenizer._tokenizer.reserved_tokens) <= 1
+        self._token_ids = functools.lru_cache(maxsize=cache_size)(self._token_to_ids)
+        self._piece_ids = functools.lru_cache(maxsize=cache_size)(self._piece_to_ids)
+
+    def __getattr__(self, name):
+        if name == 'tokenizer':
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def _insert(self, subword, idx):
+        node = self._trie
+        for char in subword:
+            node = node.setdefault(char, {})
+        node[None] = idx
+
+    def _token_to_ids(self, token):
+        ids = []
+        start, n = 0, len(token)
+        offset = self._n_subwords + 1
+        while start < n:
+            node, match, match_end = self._trie, None, start
+            for end in range(start, n):
+                node = node.get(token[end])
+                if node is None:
+                    break
+                if None in node:
+                    match, match_end = node[None], end + 1
+            if match is None:
+                # no subword starts here: byte-encode a single character
+                char = token[start]
+                if char == '_':
+                    ids.append(offset + ord(' '))
+                else:
+                    ids.extend(offset + b for b in char.encode('utf-8'))
+                start += 1
+            else:
+                ids.append(match + 1)
+                start = match_end
+        return tuple(ids)
+
+    def _piece_to_ids(self, piece):
+        token = piece.replace('_', subword_text_encoder._UNDERSCORE_REPLACEMENT)
+        if piece[-1] == ' ' and _WORD_RE.match(piece):
+            token = token[:-1] + '_'
+        return self._token_ids(token)
+
+    def encode(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')
+        if self._plain_split and subword_text_encoder._UNDERSCORE_REPLACEMENT not in s:
+            piece_ids = self._piece_ids
+            pieces = _SUBWORD_PIECE_RE.findall(s)
+        else:
+            piece_ids = self._token_ids
+            pieces = subword_text_encoder._prepare_tokens_for_encode(self._split(s))
+        return list(itertools.chain.from_iterable(map(piece_ids, pieces)))
+
+
+class SubwordEncoder(object):
+    """Batched ``SubwordTextEncoder.encode`` (or any tokenizer with ``encode``).
+
+    Every distinct sentence is encoded once and the ids are assembled into
+    a RaggedTensor from flat NumPy arrays. ``tf_encode`` runs the same
+    thing through ``tf.py_function`` so it can be used in ``Dataset.map``.
+    """
+
+    def __init__(self, tokenizer):
+        if SubwordTextEncoder is not None and isinstance(tokenizer, SubwordTextEncoder):
+            tokenizer = FastSubwordEncoder(tokenizer)
+        self.tokenizer = tokenizer
+
+    def encode(self, text):
+        return self.tokenizer.encode(text)
+
+    def encode_batch(self, texts):
+        """ (flat ids, row lengths) as int64 NumPy arrays """
+        encoded = {}
+        rows = []
+        for text in texts:
+            ids = encoded.get(text)
+            if ids is None:
+                ids = encoded[text] = self.encode(text)
+            rows.append(ids)
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        values = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64,
+                             count=int(lengths.sum()))
+        return values, lengths
+
+    def tf_encode(self, texts):
+        """ 1-D tf.string tensor -> RaggedTensor of int64 ids """
+        def _encode(batch):
+            return self.encode_batch([t.decode('utf-8') for t in batch.numpy()])
+
+        values, lengths = tf.py_function(_encode, [texts], [tf.int64, tf.int64])
+        values.set_shape([None])
+        lengths.set_shape([None])
+        return tf.RaggedTensor.from_row_lengths(values, lengths, validate=False)
+
+    def __call__(self, texts, prefix=(), suffix=()):
+        values, lengths = self.encode_batch(texts)
+        ids = tf.RaggedTensor.from_row_lengths(values, lengths, validate=False)
+        return add_special_tokens(ids, prefix, suffix)
+
+
+FROZEN_TOKENIZER_VERSION = 1
+
+
+class FrozenTokenizer(object):
+    """Read-only Keras ``Tokenizer``.
+
+    Keeps only the vocabulary (``words[i]`` has id ``i + 1``), the
+    ``word_index`` hash index over it and the settings that
+    ``texts_to_sequences`` / ``sequences_to_texts`` use. Words at or beyond
+    ``num_words`` are not stored at all, which gives the same OOV handling.
+    """
+
+    char_level = False
+
+    def __init__(self, words, oov_token=None, filters='', lower=True, split=' ', num_words=None):
+        self.words = list(words)
+        self.oov_token = oov_token
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.num_words = num_words
+        self.word_index = {word: idx for idx, word in enumerate(self.words, 1)}
+        self.index_word = dict(enumerate(self.words, 1))
+        self._oov_id = self.word_index.get(oov_token) if oov_token is not None else None
+        self._translate = str.maketrans({c: split for c in filters})
+
+    def get_config(self):
+        return {'oov_token': self.oov_token, 'filters': self.filters, 'lower': self.lower,
+                'split': self.split, 'num_words': self.num_words}
+
+    def text_to_word_sequence(self, text):
+        if self.lower:
+            text = text.lower()
+        return [word for word in text.translate(self._translate).split(self.split) if word]
+
+    def texts_to_sequences(self, texts):
+        word_index, oov_id = self.word_index, self._oov_id
+        sequences = []
+        for text in texts:
+            ids = [word_index.get(word, oov_id) for word in self.text_to_word_sequence(text)]
+            if oov_id is None:
+                ids = [idx for idx in ids if idx is not None]
+            sequences.append(ids)
+        return sequences
+
+    def sequences_to_texts(self, sequences):
+        index_word, oov_token = self.index_word, self.oov_token
+        texts = []
+        for seq in sequences:
+            words = (index_word.get(idx, oov_token) for idx in seq)
+            texts.append(' '.join(word for word in words if word is not None))
+        return texts
+
+
+def freeze_tokenizer(tokenizer):
+    """ FrozenTokenizer with the vocabulary and settings of a fitted Keras ``Tokenizer`` """
+    if isinstance(tokenizer, FrozenTokenizer):
+        return tokenizer
+    if tokenizer.char_level:
+        raise ValueError('char_level tokenizers are not supported')
+    words = sorted(tokenizer.word_index, key=tokenizer.word_index.get)
+    if tokenizer.num_words:
+        # texts_to_sequences still emits the OOV id when it is >= num_words
+        oov_id = tokenizer.word_index.get(tokenizer.oov_token, 0)
+        words = words[:max(tokenizer.num_words - 1, oov_id)]
+    return FrozenTokenizer(words, tokenizer.oov_token, tokenizer.filters, tokenizer.lower,
+                           tokenizer.split, tokenizer.num_words)
+
+
+def save_tokenizer(tokenizer, path):
+    """Write ``tokenizer`` as a frozen JSON artifact and return the frozen copy."""
+    frozen = freeze_tokenizer(tokenizer)
+    data = {'version': FROZEN_TOKENIZER_VERSION, 'config': frozen.get_config(),
+            'words': frozen.words}
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return frozen
+
+
+def load_tokenizer(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != FROZEN_TOKENIZER_VERSION:
+        raise ValueError('{}: unsupported tokenizer version {}'.format(path, data.get('version')))
+    return FrozenTokenizer(data['words'], **data['config'])
+
+
+PAD, SOS, EOS, CLS, SEP, MASK = '<PAD>', '<SOS>', '<EOS>', '<CLS>', '<SEP>', '<MASK>'
+
+
+class SpecialTokenizer(object):
+    """A tokenizer plus an explicit registry of its special tokens.
+
+    ``PAD`` is the padding id 0 that every base tokenizer already reserves,
+    special tokens the base vocabulary already has (``ByteBPETokenizer``)
+    keep their ids, and every other one is numbered right after the base
+    vocabulary, in the order given. ``vocab_size`` is then the exact size
+    of the embedding / softmax table. ``decode`` drops padding and special
+    ids with one vectorized mask; everything else is delegated to the
+    wrapped Keras ``Tokenizer`` / ``FrozenTokenizer`` or subword / BPE encoder.
+    """
+
+    def __init__(self, tokenizer, special_tokens=(PAD, SOS, EOS)):
+        self.tokenizer = tokenizer
+        self._keras = not hasattr(tokenizer, 'encode')
+        if self._keras:
+            # the ids texts_to_sequences can emit, num_words included
+            self.base_vocab_size = len(freeze_tokenizer(tokenizer).word_index) + 1
+        else:
+            self.base_vocab_size = tokenizer.vocab_size
+
+        existing = getattr(tokenizer, 'special_index', {})
+        self.special_ids = {}
+        next_id = self.base_vocab_size
+        for token in special_tokens:
+            if token in existing:
+                self.special_ids[token] = existing[token]
+            elif token == PAD:
+                self.special_ids[token] = 0
+            else:
+                self.special_ids[token] = next_id
+                next_id += 1
+        self.vocab_size = next_id
+        # special ids that sit inside the base vocabulary
+        self._inner_special_ids = np.asarray(
+            [idx for idx in existing.values() if idx > 0], dtype=np.int64)
+
+    def __getattr__(self, name):
+        if name == 'tokenizer':
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def token_id(self, token):
+        return self.special_ids[token]
+
+    def content_mask(self, ids):
+        """ True where ``ids`` is a regular token (not padding, not special) """
+        ids = np.asarray(ids)
+        mask = (ids > 0) & (ids < self.base_vocab_size)
+        if len(self._inner_special_ids):
+            mask &= ~np.isin(ids, self._inner_special_ids)
+        return mask
+
+    def strip_special(self, ids):
+        ids = np.asarray(ids)
+        return ids[self.content_mask(ids)]
+
+    def decode(self, ids):
+        ids = self.strip_special(ids).tolist()
+        if self._keras:
+            return self.tokenizer.sequences_to_texts([ids])[0]
+        return self.tokenizer.decode(ids)
+
+    def sequences_to_texts(self, sequences):
+        return [self.decode(seq) for seq in sequences]
+
+
+def vocab_coverage(tokenizer, num_words=None):
+    """Coverage of the fitted corpus when only ids below ``num_words`` are kept.
+
+    ``num_words`` defaults to the tokenizer's own; words outside the
+    vocabulary become the OOV token. Needs the ``word_counts`` of a fitted
+    Keras ``Tokenizer`` (not a frozen one).
+    """
+    num_words = num_words or tokenizer.num_words
+    total_tokens = kept_tokens = kept_types = 0
+    for word, count in tokenizer.word_counts.items():
+        total_tokens += count
+        if not num_words or tokenizer.word_index[word] < num_words:
+            kept_tokens += count
+            kept_types += 1
+    n_types = len(tokenizer.word_counts)
+    vocab_size = len(tokenizer.word_index) + 1
+    if num_words:
+        vocab_size = min(vocab_size, num_words)
+    token_coverage = kept_tokens / total_tokens if total_tokens else 1.0
+    return {'num_words': num_words,
+            'vocab_size': vocab_size,
+            'type_coverage': kept_types / n_types if n_types else 1.0,
+            'token_coverage': token_coverage,
+            'oov_rate': 1.0 - token_coverage}
+
+
+def softmax_step_time(vocab_size, hid_dim=256, n_tokens=128 * 40, repeat=5):
+    """ best-of-``repeat`` seconds for the output projection + softmax loss, forward and backward """
+    hidden = tf.random.normal([n_tokens, hid_dim])
+    kernel = tf.Variable(tf.random.normal([hid_dim, vocab_size], stddev=0.02))
+    labels = tf.random.uniform([n_tokens], maxval=vocab_size, dtype=tf.int32)
+
+    @tf.function
+    def step():
+        with tf.GradientTape() as tape:
+            logits = tf.matmul(hidden, kernel)
+            loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels, logits))
+        return tape.gradient(loss, kernel)
+
+    step()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step().numpy()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def vocab_tradeoff(tokenizer, sizes, hid_dim=256, n_tokens=128 * 40):
+    """ vocab_coverage plus output-layer parameters and softmax step time for every size """
+    rows = []
+    for num_words in list(sizes) + [None]:
+        row = vocab_coverage(tokenizer, num_words)
+        row['output_params'] = row['vocab_size'] * (hid_dim + 1)
+        row['step_ms'] = 1000 * softmax_step_time(row['vocab_size'], hid_dim, n_tokens)
+        rows.append(row)
+    return rows
+
+
+def batch_tokenizer(tokenizer):
+    """Batched encoder for a Keras ``Tokenizer``, a (Fast)``SubwordTextEncoder``
+    or a ``byte_bpe.ByteBPETokenizer``, also inside a ``SpecialTokenizer``."""
+    if isinstance(tokenizer, SpecialTokenizer):
+        tokenizer = tokenizer.tokenizer
+    if hasattr(tokenizer, 'encode'):
+        return SubwordEncoder(tokenizer)
+    return KerasTokenizerEncoder(tokenizer)
+
+
+if __name__ == '__main__':
+    from cornell_corpus import fetch_corpus
+    from corpus_store import open_corpus_store
+    from text_preprocessing import cached_preprocess
+
+    normalize = cached_preprocess()
+    store = open_corpus_store(fetch_corpus())
+    sentences = [normalize(trg) for _, trg in store.iter_pairs()]
+    tokenizer = tf.keras.preprocessing.text.Tokenizer(
+        filters='!"#$%&()*+,-./:;=?@[\\]^_`{|}~\t\n', oov_token='<unk>')
+    tokenizer.fit_on_texts(sentences)
+    print('Sentences :', len(sentences))
+    print('Words     :', len(tokenizer.word_index))
+
+    print('{:>10} {:>10} {:>9} {:>9} {:>13} {:>9}'.format(
+        'num_words', 'vocab', 'coverage', 'OOV', 'output params', 'step ms'))
+    for row in vocab_tradeoff(tokenizer, [1000, 2000, 4000, 8000, 16000]):
+        print('{:>10} {:>10} {:>8.2%} {:>8.2%} {:>13,} {:>9.2f}'.format(
+            str(row['num_words']), row['vocab_size'], row['token_coverage'],
+            row['oov_rate'], row['output_params'], row['step_ms']))